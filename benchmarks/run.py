@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""Synquiz benchmarks.
+
+Generates synthetic quizzes, serves their images from a local HTTP server
+and puts stand-ins for yt-dlp, ffmpeg and ffprobe on PATH, so no network
+access is needed. Results are written as JSON and can be compared across
+commits:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import zlib
+import struct
+import shutil
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+LIGHT_COMMANDS = [
+    ['--help'],
+    ['manage', 'template'],
+]
+
+def png(width, height, seed):
+    row = b'\x00' + bytes([(seed * 37) % 256, (seed * 91) % 256, (seed * 13) % 256]) * width
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(row * height))
+        + chunk(b'IEND', b'')
+    )
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        seed = sum(self.path.encode('utf-8'))
+        body = png(320, 240, seed)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', 'Sat, 01 Jan 2022 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_image_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+def question(i, base_url):
+    kind = ['text', 'image', 'audio', 'video', 'text', 'image', 'super'][i % 7]
+    video_url = f'https://www.youtube.com/watch?v=bench{i // 3}'
+    if kind == 'text':
+        return {'type': 'text', 'text': f'Question {i}', 'answer': f'Answer {i}'}
+    if kind == 'image':
+        return {'type': 'image', 'url': f'{base_url}/image{i}.png', 'answer': f'Answer {i}'}
+    if kind in ('audio', 'video'):
+        return {
+            'type': kind,
+            'url': video_url,
+            'start': i % 30,
+            'len': 10,
+            'answer': {'type': 'video', 'url': video_url, 'text': f'Answer {i}'},
+        }
+    return {
+        'type': 'super',
+        'text': f'Category {i}',
+        'questions': [
+            {'type': 'image', 'url': f'{base_url}/super{i}-{j}.png', 'answer': f'Answer {i}{j}'}
+            for j in range(4)
+        ],
+    }
+
+def make_quiz(home, size, base_url):
+    import yaml
+
+    home.mkdir(parents=True)
+    (home / 'data').mkdir()
+    quiz = {
+        'title': f'Benchmark {size}',
+        'subtitle': 'Synthetic quiz',
+        'quiz': [question(i, base_url) for i in range(size)],
+    }
+    (home / 'quiz.yaml').write_text(yaml.safe_dump(quiz))
+
+def make_reveal_dir(path):
+    files = [
+        'dist/reset.css',
+        'dist/reveal.css',
+        'dist/reveal.js',
+        'dist/theme/black.css',
+        'plugin/highlight/monokai.css',
+        'plugin/notes/notes.js',
+        'plugin/markdown/markdown.js',
+        'plugin/highlight/highlight.js',
+    ]
+    for f in files:
+        target = path / f
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(f'/* {f} */\n' * 2000)
+
+def arguments(command, home, reveal_dir, jobs):
+    import synquiz
+    return synquiz.parser.parse_args([
+        '--quiet', '--quiet', '--quiet',
+        '--reveal-dir', str(reveal_dir),
+        '--jobs', str(jobs),
+        *command,
+        str(home),
+    ])
+
+def timed(results, name, fn, *args):
+    start = time.perf_counter()
+    value = fn(*args)
+    results[name] = time.perf_counter() - start
+    return value
+
+def fresh_items(manager, quiz_data):
+    # Copies of the quiz's media items without their download results
+    items = manager.media_items(quiz_data['quiz'])
+    return [{k: v for k, v in m.items() if k not in ('file', 'content_type')} for m in items]
+
+def bench_quiz(workdir, size, base_url, jobs):
+    from synquiz import synquiz as sq
+    from synquiz.media import MediaManager
+    from synquiz.templates import load_template
+
+    home = workdir / f'quiz{size}'
+    reveal_dir = workdir / 'reveal'
+    make_quiz(home, size, base_url)
+    results = {}
+
+    args = arguments(['make'], home, reveal_dir, jobs)
+    quiz_data = timed(results, 'parse_cold', lambda: sq.Quiz(home, sq.media_manager(args)).parse())
+    timed(results, 'parse_warm', lambda: sq.Quiz(home, sq.media_manager(args)).parse())
+
+    manager = MediaManager(home, jobs)
+    items = fresh_items(manager, quiz_data)
+    timed(results, 'media_hit', manager.fetch_all, items)
+    results['media_hit_per_item'] = results['media_hit'] / max(1, len(items))
+
+    miss_home = workdir / f'miss{size}'
+    (miss_home / 'data').mkdir(parents=True)
+    manager = MediaManager(miss_home, jobs, source_dir=miss_home / 'source-cache')
+    items = fresh_items(manager, quiz_data)
+    timed(results, 'media_miss', manager.fetch_all, items)
+    results['media_miss_per_item'] = results['media_miss'] / max(1, len(items))
+
+    template = timed(results, 'template_load', load_template, args.template_file)
+    timed(results, 'render', sq.write_quiz, args, template, quiz_data)
+    timed(results, 'make', sq.render, args)
+
+    # Drop a tenth of the questions so clean has something to do
+    import yaml
+    quiz = yaml.safe_load((home / 'quiz.yaml').read_text())
+    quiz['quiz'] = quiz['quiz'][:size - max(1, size // 10)]
+    (home / 'quiz.yaml').write_text(yaml.safe_dump(quiz))
+    timed(results, 'clean', sq.cleanup, arguments(['clean'], home, reveal_dir, jobs))
+    timed(results, 'finalize', sq.finalize, arguments(['finalize'], home, reveal_dir, jobs))
+    return results
+
+def bench_startup(repeat):
+    results = {}
+    for command in LIGHT_COMMANDS:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, '-c', 'import sys, synquiz; sys.argv = ["synquiz"] + sys.argv[1:]; synquiz.main()', *command],
+                cwd=ROOT,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[' '.join(command)] = best
+    return results
+
+def git_revision():
+    try:
+        res = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+        return res.stdout.strip() or None
+    except OSError:
+        return None
+
+def flatten(report):
+    flat = {}
+    for size, results in report['quizzes'].items():
+        for name, value in results.items():
+            flat[f'quiz{size}.{name}'] = value
+    for name, value in report['startup'].items():
+        flat[f'startup.{name}'] = value
+    return flat
+
+def compare(report, baseline, threshold):
+    old = flatten(baseline)
+    new = flatten(report)
+    regressions = []
+    print(f"{'benchmark':40} {'before':>10} {'after':>10} {'change':>8}", file=sys.stderr)
+    for name in sorted(new):
+        if name not in old or not old[name]:
+            continue
+        change = new[name] / old[name] - 1
+        flag = ''
+        if change > threshold:
+            flag = ' !'
+            regressions.append(name)
+        print(f'{name:40} {old[name]:10.4f} {new[name]:10.4f} {change:+8.1%}{flag}', file=sys.stderr)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Run Synquiz benchmarks.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='Quiz sizes (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type=int, default=4, help='Download workers (default: %(default)s)')
+    parser.add_argument('--ytdlp-delay', type=float, default=0.0, help='Seconds each fake yt-dlp run takes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='Cold start repetitions (default: %(default)s)')
+    parser.add_argument('--startup-budget', type=float, default=0.3, help='Maximum cold start of light commands in seconds (default: %(default)s)')
+    parser.add_argument('--output', '-o', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Compare with results from an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression (default: %(default)s)')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated quizzes')
+    args = parser.parse_args()
+
+    os.environ['PATH'] = f'{ROOT / "benchmarks" / "bin"}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['SYNQUIZ_BENCH_YTDLP_DELAY'] = str(args.ytdlp_delay)
+
+    from synquiz.output import setup_logger
+    setup_logger(logging.ERROR)
+
+    workdir = Path(tempfile.mkdtemp(prefix='synquiz-bench-'))
+    # Keep the compiled template cache out of the user's home
+    os.environ.setdefault('XDG_CACHE_HOME', str(workdir / 'cache'))
+    server, base_url = start_image_server()
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'quizzes': {},
+        'startup': {},
+    }
+    try:
+        make_reveal_dir(workdir / 'reveal')
+        for size in args.sizes:
+            print(f'Benchmarking quiz with {size} questions', file=sys.stderr)
+            report['quizzes'][str(size)] = bench_quiz(workdir, size, base_url, args.jobs)
+        print('Benchmarking cold start', file=sys.stderr)
+        report['startup'] = bench_startup(args.repeat)
+    finally:
+        server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    else:
+        print(text)
+
+    failed = False
+    for command, elapsed in report['startup'].items():
+        if elapsed > args.startup_budget:
+            print(f"Cold start of 'synquiz {command}' took {elapsed:.3f}s, budget is {args.startup_budget}s", file=sys.stderr)
+            failed = True
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if compare(report, baseline, args.threshold):
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,10 @@ setup(
         'filetype',
         'requests',
     ],
+    extras_require={
+        'images': ['Pillow'],
+        'compress': ['brotli'],
+    },
     entry_points={
         'console_scripts': [
             'synquiz=synquiz:main',
@@ -1,37 +1,77 @@
+import os
 import argparse
+import importlib
+
 from pathlib import Path
 
-import synquiz.manage as manage
-from .synquiz import init, make, watch_make, finalize, cleanup
 from .output import setup_logger
+import synquiz.util as util
+import synquiz.trace as trace
 from .util import TEMPLATE_FILE
 
 def _dir_type(st):
     return Path(st).resolve()
 
+def _command(module, name):
+    # Commands import their module, and its dependencies, only when dispatched
+    def run(args):
+        return getattr(importlib.import_module(f'synquiz.{module}'), name)(args)
+    return run
+
 parser = argparse.ArgumentParser(description='Create quizzes from YAML files.')
 parser.set_defaults(func=lambda _: parser.print_help())
 parser.add_argument('--quiet', '-q', action='count', help='Less output', default=0)
-parser.add_argument('--reveal-dir', help='Reveal directory (default: %(default)s)', default=Path.home() / '.synquiz')
+parser.add_argument('--reveal-dir', type=Path, help='Reveal directory (default: %(default)s)', default=Path.home() / '.synquiz')
 parser.add_argument('--template-file', help='Template file to use (default: %(default)s)', default=TEMPLATE_FILE)
+parser.add_argument('--jobs', '-j', type=int, help='Maximum number of concurrent media downloads (default: %(default)s)', default=4)
+parser.add_argument('--host-jobs', type=int, help='Maximum number of concurrent media downloads per host (default: %(default)s)', default=2)
+parser.add_argument('--shared-cache', action='store_true', help='Share downloaded media between quizzes, stored in the Reveal directory')
+parser.add_argument('--cache-budget', type=util.parse_size, metavar='SIZE', help='Evict least recently used media when the quiz cache grows beyond SIZE, e.g., 500M')
+parser.add_argument('--shared-cache-budget', type=util.parse_size, metavar='SIZE', help='Same as --cache-budget, for the shared media cache and downloaded sources')
+parser.add_argument('--optimize-images', action='store_true', help='Resize and recompress downloaded images to the size they are shown at')
+parser.add_argument('--image-format', choices=['webp', 'jpeg'], help='Format of optimized images (default: %(default)s)', default='webp')
+parser.add_argument('--image-quality', type=int, help='Quality of optimized images (default: %(default)s)', default=80)
+parser.add_argument('--transcode', action='store_true', help='Convert audio and video to formats every browser plays, and GIFs to MP4')
+parser.add_argument('--video-bitrate', help='Video bitrate of transcoded media (default: %(default)s)', default='2M')
+parser.add_argument('--audio-bitrate', help='Audio bitrate of transcoded media (default: %(default)s)', default='128k')
+parser.add_argument('--transcode-jobs', type=int, help='Maximum number of concurrent transcodes (default: %(default)s)', default=2)
+parser.add_argument('--stats', action='store_true', help='Print a summary of where time was spent')
+parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace (Perfetto) JSON file of the run')
 subparsers = parser.add_subparsers()
 
 parser_init = subparsers.add_parser('init', help='Initialize a quiz directory')
-parser_init.set_defaults(func=init)
+parser_init.set_defaults(func=_command('synquiz', 'init'))
 
 parser_make = subparsers.add_parser('make', help='Build a PDF lecture from a markdown file.')
-parser_make.set_defaults(func=make)
+parser_make.set_defaults(func=_command('synquiz', 'make'))
 
 parser_watch = subparsers.add_parser('watch', help='Monitor a quiz and build slides when it changes.')
-parser_watch.set_defaults(func=watch_make)
+parser_watch.set_defaults(func=_command('synquiz', 'watch_make'))
+parser_watch.add_argument('--debounce', type=float, help='Seconds to wait for further changes before rebuilding (default: %(default)s)', default=0.3)
 parser_watch.add_argument('--development', '-d', action='store_true', help='Set develpment mode. Show both answerless version and asnwer version.')
 
 parser_finalize = subparsers.add_parser('finalize', help='Finalize and make a standalone quiz')
-parser_finalize.set_defaults(func=finalize)
+parser_finalize.set_defaults(func=_command('synquiz', 'finalize'))
+
+parser_make_all = subparsers.add_parser('make-all', help='Build every quiz found below a directory')
+parser_make_all.set_defaults(func=_command('synquiz', 'make_all'))
+parser_make_all.add_argument('--answers', '-a', action='store_true', help='Show answers')
+
+parser_finalize_all = subparsers.add_parser('finalize-all', help='Finalize every quiz found below a directory')
+parser_finalize_all.set_defaults(func=_command('synquiz', 'finalize_all'))
+
+for p in [parser_make_all, parser_finalize_all]:
+    p.add_argument('root', help='Directory to search for quizzes', type=_dir_type)
+    p.add_argument('--workers', '-w', type=int, help='Number of quizzes built at the same time (default: %(default)s)', default=os.cpu_count())
+    p.set_defaults(development=False)
+
+parser_check = subparsers.add_parser('check', help='Validate quizzes without downloading anything')
+parser_check.add_argument('dirs', nargs='+', metavar='dir', help='Quiz directories', type=_dir_type)
+parser_check.set_defaults(func=_command('synquiz', 'check'))
 
 parser_cleanup = subparsers.add_parser('clean', help='Remove unused media files')
 parser_cleanup.add_argument('--aggressive', '-a', action='store_true', help='Remove all files from data directory, not just the ones downloaded by quiz')
-parser_cleanup.set_defaults(func=cleanup)
+parser_cleanup.set_defaults(func=_command('synquiz', 'cleanup'))
 
 # MANAGEMENT PARSERS
 
@@ -40,18 +80,21 @@ parser_manage.set_defaults(func=lambda _: parser_manage.print_help())
 manage_subparsers = parser_manage.add_subparsers()
 
 manage_cache = manage_subparsers.add_parser('cache', help='Show contents of quiz cache')
-manage_cache.set_defaults(func=manage.show_db)
+manage_cache.set_defaults(func=_command('manage', 'show_db'))
+
+manage_revalidate = manage_subparsers.add_parser('revalidate', help='Check downloaded images for changes and update them')
+manage_revalidate.set_defaults(func=_command('manage', 'revalidate'))
 
 manage_init = manage_subparsers.add_parser('init', help='Initialize Synquiz on this machine')
-manage_init.set_defaults(func=manage.init)
+manage_init.set_defaults(func=_command('manage', 'init'), dependencies=['git'])
 
 manage_clean = manage_subparsers.add_parser('clean', help='Remove Reveal.js directory')
-manage_clean.set_defaults(func=manage.clean)
+manage_clean.set_defaults(func=_command('manage', 'clean'))
 
 manage_template = manage_subparsers.add_parser('template', help='Get default quiz template')
-manage_template.set_defaults(func=manage.template)
+manage_template.set_defaults(func=_command('manage', 'template'))
 
-parsers = [parser_watch, parser_make, parser_finalize, parser_cleanup, parser_init, manage_cache]
+parsers = [parser_watch, parser_make, parser_finalize, parser_cleanup, parser_init, manage_cache, manage_revalidate]
 
 for p in parsers:
     p.add_argument('dir', help='Quiz directory', type=_dir_type)
@@ -59,9 +102,17 @@ for p in parsers:
 
 for p in parsers[:2]:
     p.add_argument('--answers', '-a', action='store_true', help='Show answers')
+    p.add_argument('--port', '-p', type=int, help='Port to serve the quiz on (default: %(default)s)', default=8000)
 
 def main():
     args = parser.parse_args()
     setup_logger(10 + args.quiet*10)
-    manage.check_dependencies()
-    args.func(args)
+    util.check_dependencies(getattr(args, 'dependencies', []))
+    trace.tracer.enabled = args.stats or bool(args.trace)
+    try:
+        args.func(args)
+    finally:
+        if args.trace:
+            trace.tracer.write(args.trace)
+        if args.stats:
+            trace.tracer.print_summary()
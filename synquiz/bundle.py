@@ -0,0 +1,67 @@
+import re
+import gzip
+import logging
+
+import synquiz.util as util
+
+log = logging.getLogger('synquiz')
+
+HTML_REFERENCE = re.compile(r'''(?:src|href|poster)\s*=\s*["']([^"']+)["']''')
+CSS_REFERENCE = re.compile(r'''url\(\s*["']?([^"')]+)["']?\s*\)''')
+
+COMPRESSIBLE = ('.html', '.css', '.js', '.mjs', '.svg', '.json', '.txt')
+
+def is_relative(ref):
+    return not re.match(r'^([a-z][a-z0-9+.-]*:|//|#|/)', ref, re.IGNORECASE)
+
+def clean_reference(ref):
+    return ref.split('#')[0].split('?')[0]
+
+def references(path, pattern):
+    text = path.read_text(errors='replace')
+    refs = [clean_reference(r) for r in pattern.findall(text)]
+    return [r for r in refs if r and is_relative(r)]
+
+def copy_assets(pages, source, dest):
+    # Copies the files referenced by the pages, and by the stylesheets they
+    # use, from source into dest. Returns every referenced file in dest.
+    dest = dest.resolve()
+    assets = []
+    pending = [(p.parent, r) for p in pages for r in references(p, HTML_REFERENCE)]
+    seen = set()
+    while pending:
+        base, ref = pending.pop()
+        try:
+            rel = (base / ref).resolve().relative_to(dest)
+        except ValueError:
+            continue
+        if rel in seen:
+            continue
+        seen.add(rel)
+        target = dest / rel
+        if not target.exists():
+            src = source / rel
+            if not src.is_file():
+                log.warning(f'Referenced file {rel} not found')
+                continue
+            log.debug(f'  Copying {src} -> {target}')
+            target.parent.mkdir(parents=True, exist_ok=True)
+            util.link_or_copy(src, target)
+        assets.append(target)
+        if target.suffix == '.css':
+            pending.extend((target.parent, r) for r in references(target, CSS_REFERENCE))
+    return assets
+
+def precompress(paths):
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    for path in paths:
+        if path.suffix not in COMPRESSIBLE or not path.is_file():
+            continue
+        data = path.read_bytes()
+        path.with_name(path.name + '.gz').write_bytes(gzip.compress(data, 9))
+        if brotli is not None:
+            path.with_name(path.name + '.br').write_bytes(brotli.compress(data))
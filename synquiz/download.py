@@ -0,0 +1,124 @@
+import logging
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import synquiz.util as util
+
+log = logging.getLogger('synquiz')
+
+USER_AGENT = 'Mozilla/5.0 (Windows; U; Windows NT 5.1; de; rv:1.9.1.5) Gecko/20091102 Firefox/3.5.5'
+CHUNK_SIZE = 1 << 16
+TIMEOUT = (10, 60)
+ATTEMPTS = 3
+
+_session = None
+_session_lock = threading.Lock()
+
+class Result:
+    def __init__(self, status, etag=None, last_modified=None, size=0):
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+def session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=['GET', 'HEAD'],
+            )
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+            _session = requests.Session()
+            _session.headers['User-Agent'] = USER_AGENT
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+def conditional_headers(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+def range_validator(resp):
+    # If-Range needs a strong validator
+    etag = resp.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return resp.headers.get('Last-Modified')
+
+def _get(url, dest, headers):
+    # The validator of a partial download is kept next to it, a partial
+    # download is only resumed if the server confirms it has not changed
+    validator_file = dest.with_suffix('.validator')
+    offset = dest.stat().st_size if dest.exists() else 0
+    validator = validator_file.read_text() if offset and validator_file.exists() else None
+    headers = dict(headers)
+    if validator:
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+    elif offset:
+        log.debug(f'Partial download of {url} cannot be validated, starting over')
+
+    with session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as resp:
+        if resp.status_code == 304:
+            return Result(304)
+        if resp.status_code == 416 or (
+            resp.status_code == 206 and not resp.headers.get('Content-Range', '').startswith(f'bytes {offset}-')
+        ):
+            # Stale partial download, start over
+            util.remove_file(dest)
+            util.remove_file(validator_file)
+            return None
+        resp.raise_for_status()
+
+        mode = 'ab' if resp.status_code == 206 else 'wb'
+        if mode == 'ab':
+            log.debug(f'Resuming download of {url} at {offset} bytes')
+        else:
+            validator = range_validator(resp)
+            if validator:
+                validator_file.write_text(validator)
+            else:
+                util.remove_file(validator_file)
+        with open(dest, mode) as f:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        util.remove_file(validator_file)
+        return Result(
+            resp.status_code,
+            resp.headers.get('ETag'),
+            resp.headers.get('Last-Modified'),
+            dest.stat().st_size,
+        )
+
+def fetch(url, dest, etag=None, last_modified=None):
+    # Streams url into dest, resuming a partial dest left by an earlier
+    # attempt. With validators, a 304 leaves dest untouched.
+    with util.temporary_file_lock(dest.with_suffix('.lock')):
+        headers = conditional_headers(etag, last_modified)
+        for attempt in range(1, ATTEMPTS + 1):
+            try:
+                result = _get(url, dest, headers)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt == ATTEMPTS:
+                    raise
+                log.debug(f'Download of {url} interrupted, retrying')
+                continue
+            if result is not None:
+                return result
+        raise requests.RequestException(f'Could not download {url}')
@@ -0,0 +1,46 @@
+import logging
+
+log = logging.getLogger('synquiz')
+
+FORMATS = {
+    'webp': '.webp',
+    'jpeg': '.jpg',
+}
+
+# Images are rendered 400px high, leave room for high resolution displays
+DISPLAY_HEIGHT = 400
+DISPLAY_SCALE = 2
+
+# Vector and animated images are left alone
+SKIPPED = ('.svg', '.gif')
+
+def available():
+    try:
+        import PIL
+    except ImportError:
+        return False
+    return True
+
+def target_height(data):
+    return int(DISPLAY_HEIGHT * data.get('size', 1) * DISPLAY_SCALE)
+
+# Bumped when variants of the same image change, e.g., rotated upright
+VARIANT_VERSION = 2
+
+def variant_key(digest, height, fmt, quality):
+    return ('variant', digest, height, fmt, quality, VARIANT_VERSION)
+
+def optimize(src, dest, height, fmt, quality):
+    # Runs in a worker process
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as img:
+        # The EXIF orientation is not kept, portrait photos are rotated upright
+        img = ImageOps.exif_transpose(img)
+        if img.height > height:
+            width = max(1, round(img.width * height / img.height))
+            img = img.resize((width, height), Image.LANCZOS)
+        if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(dest, fmt.upper(), quality=quality, optimize=True)
+    return dest
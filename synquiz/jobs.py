@@ -0,0 +1,127 @@
+import logging
+import threading
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('synquiz')
+
+_current = threading.local()
+
+class Cancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, key, title):
+        self.key = key
+        self.title = title
+        self.future = None
+        self.cancelled = threading.Event()
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None and self.future.cancel():
+            return
+        with self.lock:
+            for process in self.processes:
+                process.terminate()
+
+def bind(fn):
+    # Wraps fn to run in another thread as part of the calling thread's job
+    job = getattr(_current, 'job', None)
+    def run_in_job(*args):
+        _current.job = job
+        try:
+            return fn(*args)
+        finally:
+            _current.job = None
+    return run_in_job
+
+def run(command, **kwargs):
+    # Like subprocess.run, but the process is terminated if the background
+    # job it runs in is cancelled
+    job = getattr(_current, 'job', None)
+    if job is None:
+        return subprocess.run(command, **kwargs)
+    if job.cancelled.is_set():
+        raise Cancelled()
+    with subprocess.Popen(command, **kwargs) as process:
+        with job.lock:
+            job.processes.add(process)
+            if job.cancelled.is_set():
+                process.terminate()
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            with job.lock:
+                job.processes.discard(process)
+    if job.cancelled.is_set():
+        raise Cancelled()
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+class JobQueue:
+    # Media downloads running in the background while watch keeps rendering.
+    # on_done is called with the key of every job that finished successfully.
+    def __init__(self, workers, on_done=None):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.on_done = on_done
+        self.jobs = {}
+        self.failed = set()
+        self.total = 0
+        self.finished = 0
+        self.lock = threading.Lock()
+
+    def submit(self, key, title, fn, *args):
+        with self.lock:
+            if key in self.jobs or key in self.failed:
+                return
+            if not self.jobs:
+                self.total = self.finished = 0
+            job = self.jobs[key] = Job(key, title)
+            self.total += 1
+            job.future = self.executor.submit(self._run, job, fn, *args)
+        log.info(f'Queued download for {title}, {self.total - self.finished} pending')
+
+    def _run(self, job, fn, *args):
+        _current.job = job
+        ok = False
+        try:
+            ok = fn(*args)
+        except Cancelled:
+            log.info(f'Download for {job.title} cancelled')
+        except:
+            log.exception(f'Download for {job.title} failed')
+        finally:
+            _current.job = None
+        if job.cancelled.is_set():
+            return
+        with self.lock:
+            if self.jobs.get(job.key) is job:
+                del self.jobs[job.key]
+            self.finished += 1
+            if not ok:
+                self.failed.add(job.key)
+            progress = f'[{self.finished}/{self.total}]'
+        if ok:
+            log.info(f'{progress} Media for {job.title} ready')
+            if self.on_done is not None:
+                self.on_done(job.key)
+        else:
+            log.warning(f'{progress} Media for {job.title} could not be fetched')
+
+    def retain(self, keys):
+        # Cancels jobs for media no longer in the quiz
+        with self.lock:
+            stale = [job for key, job in self.jobs.items() if key not in keys]
+            for job in stale:
+                del self.jobs[job.key]
+            self.total -= len(stale)
+            self.failed &= set(keys)
+        for job in stale:
+            job.cancel()
+
+    def shutdown(self):
+        self.retain(set())
+        self.executor.shutdown(wait=False)
@@ -1,32 +1,12 @@
-import os
 import logging
 import subprocess
 import shutil
+import time
 
-from .media import Cache
-from .util import TEMPLATE_FILE
+from .util import TEMPLATE_FILE, format_size
 
 log = logging.getLogger('synquiz')
 
-DEPENDENCIES = ['npm', 'git']
-
-def check_dependencies():
-    for d in DEPENDENCIES:
-        if not shutil.which(d):
-            log.error(f"Missing dependency '{d}', Synquiz will not work as expected")
-
-def patch_node_12(target):
-    res = subprocess.run(['node', '-v'], capture_output=True, universal_newlines=True)
-    is_v12 = res.stdout.startswith('v12')
-    if not is_v12:
-        return
-
-    log.info('Applying patch to Reveal.js for Node 12')
-    p_json = target / 'package.json'
-    package = p_json.read_text()
-    p_json.write_text(package.replace('"node-sass": "^4.11.0",', '"node-sass": "^4.12.0",'))
-
-
 def init(args):
     target = args.reveal_dir
     if target.is_dir():
@@ -36,13 +16,10 @@ def init(args):
         log.error(f"'{target}' already exists but is not a directory, aborting")
         return
 
+    # The built dist directory is part of the repository, so neither the
+    # history nor npm install is needed
     log.info(f'Cloning Reveal.js from github into {target}')
-    subprocess.run(['git', 'clone', 'https://github.com/hakimel/reveal.js.git', str(target)])
-    patch_node_12(target)
-
-    os.chdir(target)
-    log.info(f'Running npm install in Reveal.js')
-    subprocess.run(['npm', 'install'])
+    subprocess.run(['git', 'clone', '--depth', '1', 'https://github.com/hakimel/reveal.js.git', str(target)])
     (target / 'index.html').unlink()
 
 def clean(args):
@@ -54,10 +31,30 @@ def clean(args):
     shutil.rmtree(target)
 
 def show_db(args):
-    log.info(f'Contents of cache for {args.dir}')
+    from .media import Cache
+
     c = Cache(args.dir)
-    for k,v in c.cache.items():
-        log.info(f'  {k} -> {v}')
+    stats = c.stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = f" ({stats['hits'] / lookups:.0%})" if lookups else ''
+    log.info(f'Cache for {args.dir}')
+    log.info(f"  Entries: {stats['entries']}")
+    log.info(f"  Size: {format_size(stats['size'])}")
+    log.info(f"  Hits: {stats['hits']}{hit_rate}")
+    log.info(f"  Misses: {stats['misses']}")
+    log.info(f"  Orphaned files: {stats['orphans']} ({format_size(stats['orphan_size'])})")
+    log.info('Contents:')
+    for k, file, size, used in c.details():
+        used = time.strftime('%Y-%m-%d %H:%M', time.localtime(used)) if used else 'never'
+        size = format_size(size) if size is not None else '?'
+        log.info(f'  {k} -> {file} ({size}, last used {used})')
+
+def revalidate(args):
+    from .media import MediaManager
+
+    log.info(f'Revalidating downloaded images for {args.dir}')
+    stale = MediaManager(args.dir).revalidate()
+    log.info(f'{stale} images updated')
 
 def template(args):
     print(TEMPLATE_FILE.read_text())
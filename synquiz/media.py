@@ -1,27 +1,40 @@
+import os
+import json
 import pickle
+import sqlite3
 import subprocess
 import logging
-import filetype
 import shutil
+import threading
+import time
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
-from urllib import request, parse
+from urllib import parse
 
 import synquiz.util as util
+import synquiz.trace as trace
+import synquiz.images as images
+import synquiz.jobs as jobs
+import synquiz.probe as probe
+import synquiz.transcode as transcode
 
 log = logging.getLogger('synquiz')
 
 content_types = {
     '.opus': 'audio/ogg',
-    '.m4a': 'audio/mpeg',
+    '.m4a': 'audio/mp4',
     '.mp3': 'audio/mpeg',
     '.wav': 'audio/wav',
 
     '.mp4': 'video/mp4',
-    '.mkv': 'video/mp4',
-    '.gif': 'video/mp4',
+    '.mkv': 'video/x-matroska',
     '.webm': 'video/webm',
     '.ogg': 'video/ogg',
+
+    '.gif': 'image/gif',
 }
 
 def content_type(path):
@@ -47,6 +60,14 @@ def video_metadata(data):
 
     return False, (data['url'], start, length)
 
+def source_key(url, kind):
+    return ('source', url, kind)
+
+def source_keys(data):
+    if data.get('type') not in ('audio', 'video') or is_local_media(data):
+        return []
+    return [source_key(data['url'], kind) for kind in ('audio', 'video')]
+
 def media_cache_key(data):
     if data.get('type') == 'image':
         return data['url']
@@ -54,55 +75,374 @@ def media_cache_key(data):
         return video_metadata(data)[1]
     return None
 
+MIGRATIONS = [
+    '''
+    CREATE TABLE media (
+        key TEXT PRIMARY KEY,
+        file TEXT NOT NULL
+    )
+    ''',
+    '''
+    ALTER TABLE media ADD COLUMN hash TEXT
+    ''',
+    '''
+    CREATE INDEX media_file ON media (file)
+    ''',
+    '''
+    ALTER TABLE media ADD COLUMN etag TEXT
+    ''',
+    '''
+    ALTER TABLE media ADD COLUMN last_modified TEXT
+    ''',
+    '''
+    ALTER TABLE media ADD COLUMN last_used REAL
+    ''',
+    '''
+    CREATE TABLE files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE quiz (
+        hash TEXT PRIMARY KEY,
+        data BLOB NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE fragments (
+        key TEXT PRIMARY KEY,
+        html BLOB NOT NULL
+    )
+    ''',
+    '''
+    ALTER TABLE files ADD COLUMN meta TEXT
+    ''',
+]
+
+# Cache entries derived from other media, keyed by the source's hash
+DERIVED = ('variant', 'transcode', 'poster', 'thumbnail')
+
+def encode_key(key):
+    if isinstance(key, tuple):
+        key = list(key)
+    return json.dumps(key)
+
+def decode_key(st):
+    key = json.loads(st)
+    if isinstance(key, list):
+        key = tuple(key)
+    return key
+
 class Cache:
     def __init__(self, home):
         self.home = home
-        self.db_file = self.home / 'db.pickle'
+        self.db_file = self.home / 'db.sqlite3'
+        self.pickle_file = self.home / 'db.pickle'
+        self.lock = threading.RLock()
+        self._touched = {}
+        self._counters = {}
         self._prepare()
 
     def _prepare(self):
-        if self.db_file.exists():
-            self.cache = pickle.load(open(self.db_file, 'rb'))
-        else:
-            self.cache = {}
+        self.db = sqlite3.connect(str(self.db_file), timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with util.file_lock(self.home / 'db.lock'):
+            self._migrate()
+            if self.pickle_file.exists():
+                self._import_pickle()
+
+    def _migrate(self):
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        with self.db:
+            for i, sql in enumerate(MIGRATIONS[version:], version + 1):
+                log.debug(f'Migrating cache database to version {i}')
+                self.db.execute(sql)
+            self.db.execute(f'PRAGMA user_version = {len(MIGRATIONS)}')
+            self._index_files()
+
+    def _index_files(self):
+        # Entries from before file sizes were recorded
+        rows = self.db.execute('SELECT DISTINCT file FROM media WHERE file NOT IN (SELECT path FROM files)').fetchall()
+        for (file,) in rows:
+            path = self.home / file
+            if path.is_file():
+                self.db.execute('INSERT OR IGNORE INTO files (path, size) VALUES (?, ?)', (file, path.stat().st_size))
+
+    def _import_pickle(self):
+        log.info(f'Migrating {self.pickle_file} to {self.db_file}')
+        try:
+            with open(self.pickle_file, 'rb') as f:
+                old = pickle.load(f)
+        except Exception:
+            log.warning(f'Could not read {self.pickle_file}, ignoring it')
+            old = {}
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO media (key, file) VALUES (?, ?)',
+                [(encode_key(k), str(v)) for k, v in old.items()],
+            )
+            self._index_files()
+        self.pickle_file.rename(self.pickle_file.with_suffix('.pickle.migrated'))
 
     def write(self):
-        with open(self.db_file, 'wb') as f:
-            pickle.dump(self.cache, f)
+        # Entries are committed as they are added, use times and counters
+        # are batched until here
+        with self.lock, self.db:
+            self.db.executemany(
+                'UPDATE media SET last_used = ? WHERE key = ?',
+                [(t, encode_key(k)) for k, t in self._touched.items()],
+            )
+            self.db.executemany(
+                'INSERT INTO stats (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                list(self._counters.items()),
+            )
+            self._touched = {}
+            self._counters = {}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
 
     def contains(self, key, data):
-        if key in self.cache and (self.home / self.cache[key]).exists():
-            log.debug('Media found in cache')
-            data['file'] = self.cache[key]
-            data['content_type'] = content_type(self.cache[key])
-            return True
-        return False
-
-    def add(self, path, key, data):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT file, meta FROM media LEFT JOIN files ON files.path = media.file WHERE key = ?',
+                (encode_key(key),),
+            ).fetchone()
+        if row is None or not (self.home / row[0]).exists():
+            return False
+        log.debug('Media found in cache')
+        file, meta = row
+        data['file'] = file
+        data['content_type'] = content_type(file)
+        # Entries from before files were probed are probed on first use
+        data['meta'] = json.loads(meta) if meta else self._probe(file)
+        self.touch(key)
+        return True
+
+    def _probe(self, file, meta=None):
+        if meta is None:
+            with trace.span('media.probe', file=str(file)):
+                meta = probe.probe(self.home / file)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO files (path, size, meta) VALUES (?, ?, ?) '
+                'ON CONFLICT (path) DO UPDATE SET size = excluded.size, meta = excluded.meta',
+                (str(file), meta['size'], json.dumps(meta)),
+            )
+        return meta
+
+    def meta(self, file):
+        with self.lock:
+            row = self.db.execute('SELECT meta FROM files WHERE path = ?', (str(file),)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def touch(self, key):
+        with self.lock:
+            self._touched[key] = time.time()
+
+    def record(self, name, value=1):
+        with self.lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add(self, path, key, data, digest=None, etag=None, last_modified=None, meta=None):
         file = Path(path).relative_to(self.home)
         log.debug(f'Filename: {file}')
 
+        # Files are content addressed, so each is only probed once
+        size = (self.home / file).stat().st_size
+        if meta is None:
+            meta = self.meta(file)
+        if meta is None or meta.get('size') != size:
+            meta = None
+        meta = self._probe(file, meta)
+
         data['file'] = file
         data['content_type'] = content_type(file)
-        self.cache[key] = file
+        data['meta'] = meta
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO media (key, file, hash, etag, last_modified, last_used) VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET file = excluded.file, hash = excluded.hash, '
+                'etag = excluded.etag, last_modified = excluded.last_modified, last_used = excluded.last_used',
+                (encode_key(key), str(file), digest, etag, last_modified, time.time()),
+            )
+
+    def validators(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified FROM media WHERE key = ?', (encode_key(key),)).fetchone()
+        return row if row else (None, None)
+
+    def references(self, file):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM media WHERE file = ? LIMIT 1', (str(file),)).fetchone()
+        return row is not None
+
+    def parsed_quiz(self, digest):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM quiz WHERE hash = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception:
+            return None
+
+    def add_parsed_quiz(self, digest, data):
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO quiz (hash, data) VALUES (?, ?)', (digest, blob))
+
+    def keep_parsed_quizzes(self, digests):
+        # Only the current versions of the quiz files are kept
+        with self.lock, self.db:
+            self.db.execute(
+                f'DELETE FROM quiz WHERE hash NOT IN ({", ".join("?" * len(digests))})',
+                list(digests),
+            )
+
+    def fragments(self, keys):
+        with self.lock:
+            rows = self.db.execute(
+                f'SELECT key, html FROM fragments WHERE key IN ({", ".join("?" * len(keys))})',
+                list(keys),
+            ).fetchall()
+        return dict(rows)
+
+    def set_fragments(self, fragments, keep):
+        # Fragments of questions no longer in the quiz are dropped
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO fragments (key, html) VALUES (?, ?)',
+                list(fragments.items()),
+            )
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS keep_fragments (key TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM keep_fragments')
+            self.db.executemany('INSERT OR IGNORE INTO keep_fragments (key) VALUES (?)', [(k,) for k in keep])
+            self.db.execute('DELETE FROM fragments WHERE key NOT IN (SELECT key FROM keep_fragments)')
+
+    def forget_file(self, file):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM files WHERE path = ?', (str(file),))
+
+    def orphans(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT path, size FROM files WHERE path NOT IN (SELECT file FROM media) ORDER BY path'
+            ).fetchall()
+
+    def file_size(self, file):
+        with self.lock:
+            row = self.db.execute('SELECT size FROM files WHERE path = ?', (str(file),)).fetchone()
+        return row[0] if row else 0
+
+    def total_size(self):
+        with self.lock:
+            row = self.db.execute('SELECT SUM(size) FROM files WHERE path IN (SELECT file FROM media)').fetchone()
+        return row[0] or 0
+
+    def least_recently_used(self):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT key, file FROM media ORDER BY last_used IS NOT NULL, last_used'
+            ).fetchall()
+        return [(decode_key(k), f) for k, f in rows]
+
+    def stats(self):
+        self.write()
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM media').fetchone()[0]
+            counters = dict(self.db.execute('SELECT name, value FROM stats').fetchall())
+        orphans = self.orphans()
+        return {
+            'entries': entries,
+            'size': self.total_size(),
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'orphans': len(orphans),
+            'orphan_size': sum(size for _, size in orphans),
+        }
+
+    def details(self):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT key, file, size, last_used FROM media LEFT JOIN files ON files.path = media.file ORDER BY key'
+            ).fetchall()
+        return [(decode_key(k), f, size, used) for k, f, size, used in rows]
 
     def keys(self):
-        return self.cache.keys()
+        return [k for k, _ in self.items()]
+
+    def items(self):
+        with self.lock:
+            rows = self.db.execute('SELECT key, file FROM media ORDER BY key').fetchall()
+        return [(decode_key(k), f) for k, f in rows]
 
     def remove(self, key):
-        if key in self.cache:
-            del self.cache[key]
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM media WHERE key = ?', (encode_key(key),))
 
     def __getitem__(self, key):
-        return self.cache[key]
+        file = self.get(key)
+        if file is None:
+            raise KeyError(key)
+        return file
 
     def get(self, key):
-        return self.cache.get(key)
+        return self.entry(key)[0]
+
+    def entry(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT file, hash FROM media WHERE key = ?', (encode_key(key),)).fetchone()
+        if row is None:
+            return None, None
+        file, digest = row
+        if digest is None and (self.home / file).is_file():
+            # Entries from before content hashing are hashed on first use
+            digest = util.file_digest(self.home / file)
+            with self.lock, self.db:
+                self.db.execute('UPDATE media SET hash = ? WHERE key = ?', (digest, encode_key(key)))
+        return file, digest
 
 class MediaManager:
-    def __init__(self, home):
+    def __init__(self, home, download_jobs=4, host_jobs=2, shared_dir=None, image_profile=None, budget=None, shared_budget=None,
+                 transcode_profile=None, transcode_jobs=2, source_dir=None):
         self.home = home
+        self.image_profile = image_profile
+        self.transcode_profile = transcode_profile
+        self.transcode_jobs = max(1, transcode_jobs)
+        self.budget = budget
+        self.shared_budget = shared_budget
         self.cache = Cache(self.home)
+        self.shared = None
+        if shared_dir is not None:
+            shared_dir.mkdir(exist_ok=True)
+            util.check_data_dir(shared_dir)
+            self.shared = Cache(shared_dir)
+        # Whole downloads that clips are cut from are kept outside the quiz,
+        # so they are not bundled with it
+        if self.shared is not None and source_dir is None:
+            self.source_cache = self.shared
+        else:
+            source_dir = source_dir or util.user_cache_dir() / 'sources'
+            source_dir.mkdir(parents=True, exist_ok=True)
+            util.check_data_dir(source_dir)
+            self.source_cache = Cache(source_dir)
+        self.download_jobs = max(1, download_jobs)
+        self.host_jobs = max(1, host_jobs)
+        self._host_slots = {}
+        self._source_locks = {}
+        self._locks_lock = threading.Lock()
 
     def _handle_local_media(self, data):
         url = data['url']
@@ -120,7 +460,9 @@ class MediaManager:
             return self.home / cached
         return None
 
-    def needs_downloading(self, data):
+    def needs_downloading(self, data, record=True):
+        # record is off when only looking, the miss is counted when the
+        # media is fetched
         if is_local_media(data):
             log.debug('Media determined to be local, no downloading necessary')
             self._handle_local_media(data)
@@ -128,26 +470,325 @@ class MediaManager:
 
         key = media_cache_key(data)
         if self.cache.contains(key, data):
+            trace.count('cache.hit')
+            self.cache.record('hits')
+            return False
+        if self.shared is not None and self._from_shared(key, data):
+            trace.count('cache.shared_hit')
+            self.cache.record('hits')
+            self.shared.record('hits')
             return False
+        if record:
+            trace.count('cache.miss')
+            self.cache.record('misses')
+            if self.shared is not None:
+                self.shared.record('misses')
+        return True
+
+    def _from_shared(self, key, data):
+        file, digest = self.shared.entry(key)
+        if file is None:
+            return False
+        src = self.shared.home / file
+        if not src.is_file():
+            return False
+        log.debug('Media found in shared cache')
+        self.shared.touch(key)
+        dest = self.home / file
+        dest.parent.mkdir(exist_ok=True)
+        util.link_or_copy(src, dest)
+        self.cache.add(str(dest), key, data, digest, meta=self.shared.meta(file))
+        return True
+
+    def _add(self, dest, key, data, digest, etag=None, last_modified=None):
+        self.cache.add(str(dest), key, data, digest, etag, last_modified)
+        if self.shared is None:
+            return
+        shared_dest = self.shared.home / dest.relative_to(self.home)
+        try:
+            shared_dest.parent.mkdir(exist_ok=True)
+            util.link_or_copy(dest, shared_dest)
+        except OSError:
+            log.warning(f'Could not add {dest.name} to the shared cache')
+            return
+        self.shared.add(str(shared_dest), key, {}, digest, etag, last_modified, data.get('meta'))
+
+    def _host_slot(self, url):
+        host = parse.urlparse(url).netloc.lower()
+        with self._locks_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.host_jobs)
+            return self._host_slots[host]
+
+    def _source_lock(self, url):
+        with self._locks_lock:
+            return self._source_locks.setdefault(url, threading.Lock())
+
+    @contextmanager
+    def _shared_lock(self, name, cache=None):
+        # Other processes building from the same shared cache wait here and
+        # then find the media in the shared cache instead of fetching it again
+        cache = cache or self.shared
+        if cache is None:
+            yield
+            return
+        locks = cache.home / 'locks'
+        locks.mkdir(exist_ok=True)
+        with util.file_lock(locks / f'{util.bytes_digest(encode_key(name).encode("utf-8"))[:16]}.lock'):
+            yield
+
+    def _fetch(self, items):
+        # All items share a cache key, so only the first one is downloaded
+        first, *rest = items
+        handler = self.handle_image if first['type'] == 'image' else self.handle_media
+        with self._shared_lock(media_cache_key(first)), trace.span(f'media.{first["type"]}', title=first.get('title')):
+            handler(first)
+        for data in rest:
+            self.cache.contains(media_cache_key(data), data)
+
+    def _fetch_background(self, items):
+        self._fetch(items)
+        self.postprocess(items)
+        return all('file' in data for data in items)
+
+    def _postprocess_background(self, items):
+        # Files that still cannot be made are not retried until the quiz changes
+        self.postprocess(items)
+        return not self.postprocess(items, run=False)
+
+    def _submit(self, background, key, group, fn):
+        # The job works on copies, the questions are rendered in the
+        # meantime. The rebuild after the job finds the results cached.
+        copies = [dict(data) for data in group]
+        for data in group:
+            data['pending'] = True
+        background.submit(key, group[0].get('title'), fn, copies)
+
+    def fetch_all(self, items, background=None):
+        # With a background job queue, media that is not cached, or that
+        # files derived from it still have to be made for, is processed there
+        # and marked as pending in the meantime
+        groups = OrderedDict()
+        for data in items:
+            if is_local_media(data):
+                self._handle_local_media(data)
+                continue
+            groups.setdefault(media_cache_key(data), []).append(data)
+
+        if background is not None:
+            for key, group in list(groups.items()):
+                first, *rest = group
+                if not self.needs_downloading(first, record=False):
+                    for data in rest:
+                        self.cache.contains(key, data)
+                    continue
+                del groups[key]
+                if key not in background.failed:
+                    self._submit(background, key, group, self._fetch_background)
+            keys = set(media_cache_key(d) for d in items if not is_local_media(d))
+
+            groups = OrderedDict((k, g) for k, g in groups.items() if 'file' in g[0])
+            waiting = OrderedDict()
+            for data in self.postprocess([d for g in groups.values() for d in g], run=False):
+                waiting.setdefault(('derived', media_cache_key(data)), OrderedDict())[id(data)] = data
+            for key, group in waiting.items():
+                if key not in background.failed:
+                    self._submit(background, key, list(group.values()), self._postprocess_background)
+            background.retain(keys | set(waiting))
+            return
+
+        if groups:
+            log.debug(f'Fetching {len(groups)} media items with {self.download_jobs} workers')
+            with trace.span('media.fetch_all', items=len(groups)), ThreadPoolExecutor(max_workers=self.download_jobs) as executor:
+                for future in [executor.submit(self._fetch, g) for g in groups.values()]:
+                    future.result()
+
+        self.postprocess([d for g in groups.values() for d in g])
+
+    def postprocess(self, items, run=True):
+        # Makes the files derived from the media. Files made earlier are
+        # looked up first. Without run, nothing is made and the items still
+        # missing derived files are returned instead.
+        steps = []
+        if self.image_profile is not None:
+            steps.append((self.optimize_images, self._images_to_optimize([d for d in items if d['type'] == 'image'])))
+        if self.transcode_profile is not None:
+            steps.append((self.transcode, self._media_to_transcode([d for d in items if 'file' in d])))
+        steps.append((self.posters, self._frames_to_extract([d for d in items if d['type'] == 'video' and 'file' in d])))
+        if not run:
+            return [data for _, pending in steps for entry in pending.values() for data in entry[-1]]
+        for make, pending in steps:
+            if pending:
+                make(pending)
+        return []
+
+    def _derived(self, key, field, data):
+        # Files derived from the media, stored next to it in the cache
+        file = self.cache.get(key)
+        if file is not None and (self.home / file).is_file():
+            self.cache.touch(key)
+        else:
+            linked = {}
+            if self.shared is None or not self._from_shared(key, linked):
+                return False
+            file = linked['file']
+        data[field] = file
         return True
 
+    def _frames_to_extract(self, items):
+        # Poster frames let video slides paint before the video is loaded,
+        # thumbnails are shown in the development overview
+        pending = OrderedDict()
+        if not shutil.which('ffmpeg'):
+            return pending
+
+        for data in items:
+            digest = self.cache.entry(media_cache_key(data))[1]
+            if digest is None or Path(data['file']).suffix.lower() == '.gif':
+                continue
+            found = [
+                self._derived(transcode.poster_key(digest), 'poster', data),
+                self._derived(transcode.thumbnail_key(digest), 'thumbnail', data),
+            ]
+            if not all(found):
+                pending.setdefault(digest, (data['file'], []))[1].append(data)
+        return pending
+
+    def posters(self, pending):
+        log.info(f'Extracting {len(pending)} poster frames')
+        # ffmpeg is terminated when a background job extracting frames is cancelled
+        frame = jobs.bind(transcode.frame)
+        with trace.span('media.posters', files=len(pending)), ThreadPoolExecutor(max_workers=self.transcode_jobs) as executor:
+            futures = {}
+            for digest, (file, _) in pending.items():
+                poster = self.partial_dir() / f'{util.randstr()}.jpg'
+                thumbnail = self.partial_dir() / f'{util.randstr()}.jpg'
+                futures[digest] = (
+                    executor.submit(frame, self.home / file, poster),
+                    executor.submit(frame, self.home / file, thumbnail, transcode.THUMBNAIL_HEIGHT),
+                )
+            for digest, (poster, thumbnail) in futures.items():
+                for future, key, field in [
+                    (poster, transcode.poster_key(digest), 'poster'),
+                    (thumbnail, transcode.thumbnail_key(digest), 'thumbnail'),
+                ]:
+                    try:
+                        path = future.result()
+                    except jobs.Cancelled:
+                        raise
+                    except Exception as ex:
+                        log.warning(f'Could not extract a frame from {pending[digest][0]}')
+                        log.warning(str(ex))
+                        continue
+                    frame_digest, dest = self.store(path)
+                    self._add(dest, key, {}, frame_digest)
+                    for data in pending[digest][1]:
+                        self._derived(key, field, data)
+
+    def _media_to_transcode(self, items):
+        pending = OrderedDict()
+        if not shutil.which('ffmpeg'):
+            log.error('Command ffmpeg not found. Unable to transcode media')
+            return pending
+
+        video_bitrate, audio_bitrate = self.transcode_profile
+        for data in items:
+            file, digest = self.cache.entry(media_cache_key(data))
+            if digest is None:
+                continue
+            kind = transcode.kind(data, file)
+            if kind is None:
+                continue
+            key = transcode.variant_key(digest, kind, video_bitrate, audio_bitrate)
+            if self.cache.contains(key, data) or (self.shared is not None and self._from_shared(key, data)):
+                continue
+            pending.setdefault(key, (file, kind, []))[2].append(data)
+        return pending
+
+    def transcode(self, pending):
+        video_bitrate, audio_bitrate = self.transcode_profile
+        log.info(f'Transcoding {len(pending)} media files')
+        # Workers only wait for ffmpeg, which is terminated when a background
+        # job transcoding media is cancelled
+        run = jobs.bind(transcode.transcode)
+        with trace.span('media.transcode', files=len(pending)), ThreadPoolExecutor(max_workers=self.transcode_jobs) as executor:
+            futures = {}
+            for key, (file, kind, _) in pending.items():
+                dest = self.partial_dir() / f'{util.randstr()}{transcode.SUFFIXES[kind]}'
+                futures[key] = executor.submit(run, self.home / file, dest, kind, video_bitrate, audio_bitrate)
+            for key, future in futures.items():
+                try:
+                    dest = future.result()
+                except jobs.Cancelled:
+                    raise
+                except Exception as ex:
+                    log.warning(f'Could not transcode {pending[key][0]}')
+                    log.warning(str(ex))
+                    continue
+                digest, dest = self.store(dest)
+                for data in pending[key][2]:
+                    self._add(dest, key, data, digest)
+
+    def _images_to_optimize(self, items):
+        pending = OrderedDict()
+        if not images.available():
+            log.error('Pillow not found. Unable to optimize images')
+            return pending
+
+        fmt, quality = self.image_profile
+        for data in items:
+            file, digest = self.cache.entry(data['url'])
+            if digest is None or Path(file).suffix.lower() in images.SKIPPED:
+                continue
+            height = images.target_height(data)
+            key = images.variant_key(digest, height, fmt, quality)
+            if self.cache.contains(key, data) or (self.shared is not None and self._from_shared(key, data)):
+                continue
+            pending.setdefault(key, (file, height, []))[2].append(data)
+        return pending
+
+    def optimize_images(self, pending):
+        fmt, quality = self.image_profile
+        log.info(f'Optimizing {len(pending)} images')
+        with trace.span('media.optimize_images', images=len(pending)), ProcessPoolExecutor() as executor:
+            futures = {}
+            for key, (file, height, _) in pending.items():
+                dest = self.partial_dir() / f'{util.randstr()}{images.FORMATS[fmt]}'
+                futures[key] = executor.submit(images.optimize, self.home / file, dest, height, fmt, quality)
+            for key, future in futures.items():
+                try:
+                    dest = future.result()
+                except Exception:
+                    log.exception(f'Could not optimize {pending[key][0]}')
+                    continue
+                digest, dest = self.store(dest)
+                for data in pending[key][2]:
+                    self._add(dest, key, data, digest)
+
     def handle_image(self, data):
         if not self.needs_downloading(data):
             return
 
         url = data['url']
 
+        from . import download
 
         log.info('Downloading media...')
+        part = self.partial_file(url)
         try:
-            req = request.Request(url)
-            req.add_header('User-Agent', 'Mozilla/5.0 (Windows; U; Windows NT 5.1; de; rv:1.9.1.5) Gecko/20091102 Firefox/3.5.5')
-            resp = request.urlopen(req)
-        except:
+            with self._host_slot(url), trace.span('download.image', url=url) as span:
+                result = download.fetch(url, part)
+                span['bytes'] = result.size
+            trace.count('download.bytes', result.size)
+        except Exception:
             log.exception(f"Could not download image '{url}' for {data.get('title')}")
             return
         log.info('Image data successfully downloaded')
-        img_data = resp.read()
+
+        self._store_image(url, part, data, result)
+
+    def _store_image(self, url, part, data, result):
+        import filetype
 
         parsed = parse.urlparse(url)
         parts = parsed.path.split('.')
@@ -155,91 +796,204 @@ class MediaManager:
         if parts:
             url_ext = parts[-1].split('/')[0]
 
-        if not filetype.is_image(img_data) and url_ext != 'svg':
-            kind = filetype.guess(img_data)
-            if not kind:
+        img_type = filetype.guess(str(part))
+        if not filetype.is_image(str(part)) and url_ext != 'svg':
+            if not img_type:
                 mime = 'Unknown'
             else:
-                mime = kind.mime
+                mime = img_type.mime
             log.warning(f"Downloaded object does not appear to be an image: {mime} (file is saved anyway, in case we are wrong)")
 
-        img_type = filetype.guess(img_data)
         ext = url_ext or 'img'
         if img_type:
             ext = img_type.extension
-        dest = self.home / 'data' / f'{util.randstr()}.{ext}'
-        dest.write_bytes(img_data)
+        digest, dest = self.store(part.rename(part.with_suffix(f'.{ext}')))
+        self._add(dest, url, data, digest, result.etag, result.last_modified)
+
+    def partial_file(self, url):
+        # Named after the URL, so an interrupted download can be resumed
+        return self.partial_dir() / f'{util.bytes_digest(url.encode("utf-8"))[:16]}.part'
 
-        self.cache.add(str(dest), url, data)
+    def revalidate(self):
+        from . import download
+
+        stale = 0
+        for key, file in self.cache.items():
+            if not isinstance(key, str):
+                continue
+            etag, last_modified = self.cache.validators(key)
+            if not etag and not last_modified:
+                log.debug(f'No validators for {key}, skipping')
+                continue
+            part = self.partial_file(key)
+            try:
+                result = download.fetch(key, part, etag, last_modified)
+            except Exception:
+                log.warning(f"Could not revalidate '{key}'")
+                continue
+            if result.not_modified:
+                log.debug(f'Up to date: {key}')
+                continue
+            log.info(f'Changed: {key}')
+            stale += 1
+            self._store_image(key, part, {}, result)
+        self.save_cache()
+        return stale
 
     def handle_media(self, data):
-        if not shutil.which('yt-dlp'):
-            log.error('Command yt-dlp not found. Unable to add video/audio question')
-            return
         if not self.needs_downloading(data):
             return
 
-        url = data['url']
         audio_only = data['type'] == 'audio'
         get_all, key = video_metadata(data)
-        _, start, length = key
-        name = util.randstr()
-        data_dir = self.home / 'data'
-        file_format = f'{data_dir}/{name}.%(ext)s'
+        url, start, length = key
+
+        source = self.source(url, audio_only, data.get('title'))
+        if source is None:
+            return
+        path, digest = source
+
+        if get_all:
+            dest = self.data_file(digest, path.suffix)
+            util.link_or_copy(path, dest)
+            self._add(dest, key, data, digest)
+            return
+
+        clip = self.cut(path, start, length, audio_only)
+        if clip is None:
+            log.warning(f"Error cutting '{url}' for {data.get('title')}")
+            return
+        digest, dest = self.store(clip)
+        self._add(dest, key, data, digest)
+
+    def source(self, url, audio_only, title=None):
+        # Each URL is downloaded once, clips are cut from the local copy.
+        # Audio can be cut from a video source, but not the other way around.
+        kinds = ['audio', 'video'] if audio_only else ['video']
+        # Returns the path and digest of the source
+        with self._source_lock(url), self._shared_lock(('source', url), self.source_cache):
+            for kind in kinds:
+                key = source_key(url, kind)
+                file, digest = self.source_cache.entry(key)
+                if file is not None and (self.source_cache.home / file).is_file():
+                    log.debug(f'Source for {url} found in cache')
+                    self.source_cache.touch(key)
+                    return self.source_cache.home / file, digest
+            return self._download_source(url, kinds[0], title)
+
+    def _download_source(self, url, kind, title):
+        if not shutil.which('yt-dlp'):
+            log.error('Command yt-dlp not found. Unable to add video/audio question')
+            return None
+
+        file_format = f'{self.partial_dir(self.source_cache.home)}/{util.randstr()}.%(ext)s'
 
         log.info('Downloading media...')
 
         extra_options = []
-        if audio_only:
+        if kind == 'audio':
             extra_options = [
                 '-x',
             ]
 
-        postprocessor = []
-        if not get_all:
-            postprocessor = [
-                '--postprocessor-args',
-                f'-ss {util.to_hms(start)} -t {util.to_hms(length)}',
-            ]
         command = [
             'yt-dlp',
             '-o',
             file_format,
-            *postprocessor,
+            '--no-simulate',
+            '--print',
+            'after_move:filepath',
             *extra_options,
             url,
         ]
-        result = subprocess.run(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            encoding='utf-8',
-        )
+        with self._host_slot(url), trace.span('download.source', url=url, kind=kind):
+            result = jobs.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                encoding='utf-8',
+            )
 
         if result.returncode != 0:
-            log.warning(f"Error downloading '{url}' for {data.get('title')}")
-            log.warning(result.stdout)
-            return
+            log.warning(f"Error downloading '{url}' for {title}")
+            log.warning(result.stderr)
+            return None
 
         log.info('Media download done')
+        log.debug(result.stderr)
 
-        downloaded = list(data_dir.glob(f'{name}.*'))
-
-        log.debug(result.stdout)
-        if not downloaded:
-            log.warning('No file name found for download {url}')
+        # yt-dlp prints the final path of each downloaded file
+        downloaded = [Path(line) for line in result.stdout.splitlines() if line.strip()]
+        if not downloaded or not downloaded[-1].is_file():
+            log.warning(f'No file name found for download {url}')
             log.warning(result.stdout)
-            return
+            return None
         if len(downloaded) > 1:
-            log.warning('More than one file donwloaded for {url}')
+            log.warning(f'More than one file downloaded for {url}')
             log.warning(result.stdout)
-            return
+            return None
 
-        downloaded_file = downloaded[0]
-        full_path = str(downloaded_file.resolve())
+        trace.count('download.bytes', downloaded[0].stat().st_size)
+        digest, dest = self.store(downloaded[0], 'sources', self.source_cache.home)
+        self.source_cache.add(str(dest), source_key(url, kind), {}, digest)
+        return dest, digest
 
-        self.cache.add(full_path, key, data)
+    def cut(self, source, start, length, audio_only):
+        if not shutil.which('ffmpeg'):
+            log.error('Command ffmpeg not found. Unable to cut video/audio question')
+            return None
+
+        suffix = '.opus' if audio_only else '.mp4'
+        dest = self.partial_dir() / f'{util.randstr()}{suffix}'
+        extra_options = ['-vn'] if audio_only else []
+        command = [
+            'ffmpeg',
+            '-nostdin',
+            '-y',
+            '-loglevel',
+            'error',
+            '-ss',
+            util.to_hms(start),
+            '-i',
+            str(source),
+            '-t',
+            util.to_hms(length),
+            *extra_options,
+            str(dest),
+        ]
+        log.debug(f'Cutting {source.name} at {util.to_hms(start)}')
+        with trace.span('media.cut', source=source.name, start=start, length=length):
+            result = jobs.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                encoding='utf-8',
+            )
+        if result.returncode != 0 or not dest.is_file():
+            log.warning(result.stdout)
+            return None
+        return dest
+
+    def partial_dir(self, home=None):
+        path = (home or self.home) / 'data' / '.partial'
+        path.mkdir(exist_ok=True)
+        return path
 
+    def data_file(self, digest, suffix, directory='data', home=None):
+        return (home or self.home) / directory / f'{digest}{suffix}'
+
+    def store(self, path, directory='data', home=None):
+        # home is the cache directory the file is stored in, the partial
+        # file must be on the same file system
+        ((home or self.home) / directory).mkdir(exist_ok=True)
+        digest = util.file_digest(path)
+        dest = self.data_file(digest, path.suffix, directory, home)
+        if dest.exists():
+            log.debug(f'Identical content already stored in {dest.name}')
+            path.unlink()
+        else:
+            os.replace(path, dest)
+        return digest, dest
 
     def media_items(self, questions):
         res = []
@@ -252,23 +1006,75 @@ class MediaManager:
                 res.extend(self.media_items(q['questions']))
         return res
 
+    def used_keys(self, items, cache=None):
+        cache = cache or self.cache
+        keys = set(map(media_cache_key, items))
+        if cache is self.source_cache:
+            keys.update(k for item in items for k in source_keys(item))
+        # Keep files derived from media still in use
+        digests = set(cache.entry(k)[1] for k in keys)
+        keys.update(k for k in cache.keys() if isinstance(k, tuple) and k[0] in DERIVED and k[1] in digests)
+        return keys
+
+    def _remove(self, cache, keys):
+        for k in keys:
+            file = cache[k]
+            cache.remove(k)
+            # Identical content is shared between entries
+            if not cache.references(file):
+                self._delete_file(cache, file)
+
+    def _delete_file(self, cache, file):
+        path = cache.home / file
+        if path.is_file():
+            log.debug(f'Deleting {path}')
+            path.unlink()
+        cache.forget_file(file)
+
+    def evict(self, items):
+        # Drop least recently used entries until the cache fits its budget,
+        # never touching media used by the current quiz
+        # Sources are machine-wide like the shared cache and share its budget
+        stores = [(self.cache, self.budget), (self.source_cache, self.shared_budget)]
+        if self.shared is not None and self.shared is not self.source_cache:
+            stores.append((self.shared, self.shared_budget))
+        for cache, budget in stores:
+            if budget is None:
+                continue
+            cache.write()
+            size = cache.total_size()
+            if size <= budget:
+                continue
+            used = self.used_keys(items, cache)
+            evicted = []
+            for key, file in cache.least_recently_used():
+                if size <= budget:
+                    break
+                if key in used:
+                    continue
+                cache.remove(key)
+                evicted.append(key)
+                if not cache.references(file):
+                    size -= cache.file_size(file)
+                    self._delete_file(cache, file)
+            if evicted:
+                log.info(f'Evicted {len(evicted)} cache entries from {cache.home}')
+            if size > budget:
+                log.warning(f'Media in use does not fit the cache budget of {cache.home}')
+
     def clean(self, quiz_data, remove_all=False):
         log.info('Cleaning up cached unused files')
-        media = set(map(media_cache_key, self.media_items(quiz_data['quiz'])))
-        keys = set(self.cache.keys())
-        keys = keys - media
+        items = self.media_items(quiz_data['quiz'])
+        keys = set(self.cache.keys()) - self.used_keys(items)
+        orphans = [file for file, _ in self.cache.orphans()]
 
-        if not keys:
+        if not keys and not orphans:
             log.info('Nothing to do')
         else:
-            log.info(f'{len(keys)} files to delete')
-            for k in keys:
-                path = self.home / self.cache[k]
-                if path.is_file():
-                    log.debug(f'Deleting {path}')
-                    path.unlink()
-                self.cache.remove(k)
-
+            log.info(f'{len(keys) + len(orphans)} files to delete')
+            self._remove(self.cache, keys)
+            for file in orphans:
+                self._delete_file(self.cache, file)
             self.cache.write()
 
         if not remove_all:
@@ -276,7 +1082,10 @@ class MediaManager:
 
         log.info('Cleaning up all files not used in quiz')
 
-        files = set(map(lambda x: self.media_file(x), self.media_items(quiz_data['quiz'])))
+        # Everything left in the index is in use, only files unknown to it
+        # need to be looked at
+        files = set(self.home / file for _, file in self.cache.items())
+        files.update(self.home / m['url'] for m in items if is_local_media(m))
         data_files = set([p for p in (self.home / 'data').glob('*') if p.is_file()])
         to_delete = data_files - files
 
@@ -291,3 +1100,6 @@ class MediaManager:
 
     def save_cache(self):
         self.cache.write()
+        self.source_cache.write()
+        if self.shared is not None and self.shared is not self.source_cache:
+            self.shared.write()
@@ -0,0 +1,127 @@
+import json
+import struct
+import shutil
+import logging
+import subprocess
+
+from pathlib import Path
+
+import synquiz.jobs as jobs
+
+log = logging.getLogger('synquiz')
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+AV_SUFFIXES = ('.opus', '.m4a', '.mp3', '.wav', '.mp4', '.mkv', '.webm', '.ogg')
+HEADER_SIZE = 1 << 16
+
+# JPEG start of frame markers, which hold the dimensions
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+def _png(head):
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return 'png', width, height
+
+def _gif(head):
+    if head[:4] == b'GIF8':
+        width, height = struct.unpack('<HH', head[6:10])
+        return 'gif', width, height
+
+def _webp(head):
+    if head[:4] != b'RIFF' or head[8:12] != b'WEBP':
+        return None
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack('<HH', head[26:30])
+        return 'webp', width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        bits = struct.unpack('<I', head[21:25])[0]
+        return 'webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return 'webp', width, height
+
+def _jpeg(head):
+    if head[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(head):
+        if head[i] != 0xff:
+            return None
+        marker = head[i + 1]
+        if marker == 0xff:
+            i += 1
+            continue
+        if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+            i += 2
+            continue
+        length = struct.unpack('>H', head[i + 2:i + 4])[0]
+        if marker in SOF_MARKERS:
+            height, width = struct.unpack('>HH', head[i + 5:i + 9])
+            return 'jpeg', width, height
+        i += 2 + length
+
+def image_meta(path):
+    # Only the start of the file is read, the dimensions are in the header
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+    for parse in (_png, _gif, _webp, _jpeg):
+        try:
+            found = parse(head)
+        except struct.error:
+            found = None
+        if found:
+            codec, width, height = found
+            return {'codec': codec, 'width': width, 'height': height}
+    return {}
+
+def av_meta(path):
+    if not shutil.which('ffprobe'):
+        log.debug('ffprobe not found, not probing audio/video')
+        return {}
+    command = [
+        'ffprobe',
+        '-v',
+        'error',
+        '-print_format',
+        'json',
+        '-show_format',
+        '-show_streams',
+        str(path),
+    ]
+    result = jobs.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+    if result.returncode != 0:
+        log.debug(f'Could not probe {path}: {result.stderr}')
+        return {}
+    try:
+        info = json.loads(result.stdout)
+    except ValueError:
+        return {}
+
+    meta = {}
+    duration = info.get('format', {}).get('duration')
+    if duration is not None:
+        meta['duration'] = float(duration)
+    streams = info.get('streams', [])
+    video = [s for s in streams if s.get('codec_type') == 'video' and s.get('disposition', {}).get('attached_pic') != 1]
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+    if video:
+        meta['codec'] = video[0].get('codec_name')
+        meta['width'] = video[0].get('width')
+        meta['height'] = video[0].get('height')
+    if audio:
+        meta.setdefault('codec', audio[0].get('codec_name'))
+        meta['audio_codec'] = audio[0].get('codec_name')
+    return {k: v for k, v in meta.items() if v is not None}
+
+def probe(path):
+    path = Path(path)
+    suffix = path.suffix.lower()
+    meta = {}
+    if suffix in IMAGE_SUFFIXES:
+        meta = image_meta(path)
+    elif suffix in AV_SUFFIXES:
+        meta = av_meta(path)
+    meta['size'] = path.stat().st_size
+    return meta
@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import mimetypes
+import threading
+import time
+
+from pathlib import Path
+from urllib import parse
+
+from .media import content_types
+
+log = logging.getLogger('synquiz')
+
+CHUNK_SIZE = 1 << 16
+EVENTS_PATH = '/__synquiz/events'
+HEARTBEAT = 15
+
+# Reveal.js keeps the current slide in the URL, so a reload stays in place
+RELOAD_SCRIPT = f'''
+<script>
+  (function() {{
+    var events = new EventSource('{EVENTS_PATH}');
+    events.addEventListener('reload', function() {{ location.reload(); }});
+  }})();
+</script>
+'''.encode('utf-8')
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+}
+
+def guess_type(path):
+    if path.suffix in content_types:
+        return content_types[path.suffix]
+    return mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+
+def parse_range(header, size):
+    # Returns (start, end) inclusive, None for the whole file, or False if
+    # the range cannot be satisfied. Only single ranges are supported.
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            length = int(end)
+            if length == 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+class DevServer:
+    def __init__(self, home, reveal_dir, port=8000, host='localhost'):
+        self.roots = [Path(home).resolve(), Path(reveal_dir).resolve()]
+        self.port = port
+        self.host = host
+        self.loop = None
+        self.clients = set()
+        self.connections = {}
+        self._thread = None
+        self._started = threading.Event()
+        self._stopped = None
+        self.listening = False
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if not self.listening:
+            raise OSError(f'Could not listen on {self.host}:{self.port}')
+        log.info(f'Serving quiz on http://{self.host}:{self.port}')
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.loop is not None and self._stopped is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self._started.set()
+            self.loop.close()
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        try:
+            server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as ex:
+            log.error(f'Could not listen on {self.host}:{self.port}: {ex}')
+            return
+        self.listening = True
+        self._started.set()
+        async with server:
+            await self._stopped.wait()
+            # Open connections keep the server from closing. Event streams
+            # are ended and idle keep-alive connections dropped.
+            server.close()
+            for queue in list(self.clients):
+                queue.put_nowait(None)
+            for writer in list(self.connections.values()):
+                writer.close()
+            await asyncio.gather(*self.connections, return_exceptions=True)
+
+    def serve_forever(self):
+        while self._thread.is_alive():
+            time.sleep(1)
+
+    def reload(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._broadcast, 'reload')
+
+    def _broadcast(self, event):
+        for queue in self.clients:
+            queue.put_nowait(event)
+
+    def resolve(self, url_path):
+        rel = parse.unquote(url_path).lstrip('/') or 'index.html'
+        for root in self.roots:
+            path = (root / rel).resolve()
+            if root != path and root not in path.parents:
+                continue
+            if path.is_dir():
+                path = path / 'index.html'
+            if path.is_file():
+                return path
+        return None
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            await self._respond(writer, 400)
+            return False
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        url_path = parse.urlsplit(target).path
+        if method not in ('GET', 'HEAD'):
+            await self._respond(writer, 405)
+            return False
+        if url_path == EVENTS_PATH:
+            await self._events(writer)
+            return False
+
+        path = self.resolve(url_path)
+        if path is None:
+            await self._respond(writer, 404)
+        else:
+            await self._send_file(writer, path, headers.get('range'), method == 'HEAD')
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        return keep_alive
+
+    async def _respond(self, writer, status, headers=None, body=b''):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        lines.extend(f'{k}: {v}' for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _send_file(self, writer, path, range_header, head_only):
+        headers = {
+            'Content-Type': guess_type(path),
+            'Cache-Control': 'no-cache',
+            'Accept-Ranges': 'bytes',
+        }
+        if path.suffix == '.html':
+            body = path.read_bytes().replace(b'</body>', RELOAD_SCRIPT + b'</body>', 1)
+            headers['Content-Length'] = str(len(body))
+            await self._respond(writer, 200, headers, b'' if head_only else body)
+            return
+
+        size = path.stat().st_size
+        byte_range = parse_range(range_header, size)
+        if byte_range is False:
+            headers['Content-Range'] = f'bytes */{size}'
+            await self._respond(writer, 416, headers)
+            return
+
+        status = 200
+        start, end = 0, size - 1
+        if byte_range is not None:
+            status = 206
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        length = end - start + 1
+        headers['Content-Length'] = str(length)
+        await self._respond(writer, status, headers)
+        if head_only:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                writer.write(chunk)
+                await writer.drain()
+
+    async def _events(self, writer):
+        queue = asyncio.Queue()
+        self.clients.add(queue)
+        try:
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/event-stream\r\n'
+                b'Cache-Control: no-cache\r\n'
+                b'Connection: keep-alive\r\n\r\n'
+            )
+            await writer.drain()
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), HEARTBEAT)
+                except asyncio.TimeoutError:
+                    writer.write(b': heartbeat\n\n')
+                else:
+                    if event is None:
+                        break
+                    writer.write(f'event: {event}\ndata: {{}}\n\n'.encode('utf-8'))
+                await writer.drain()
+        finally:
+            self.clients.discard(queue)
@@ -1,41 +1,152 @@
+import os
+import sys
+import copy
 import yaml
 import string
 import time
-import shutil
 import logging
+import argparse
+import threading
 
-from mako.template import Template
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import synquiz.util as util
+import synquiz.trace as trace
+import synquiz.bundle as bundle
 import synquiz.validator as validator
-from .media import MediaManager
+from .jobs import JobQueue
+from .media import MediaManager, is_local_media
+from .templates import load_template
 
 log = logging.getLogger('synquiz')
 
-link_paths = [
-    'data',
-    'index.html',
-]
+# The C loader is only available when PyYAML was built against libyaml
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 TYPES = ['text', 'audio', 'video', 'image', 'super']
+ANSWER_TYPES = ['text', 'audio', 'video', 'image']
+
+# Number of slides around the current one whose media is loaded
+MEDIA_WINDOW = 3
 
 class Quiz:
-    def __init__(self, home):
+    def __init__(self, home, media_manager=None):
         self.home = home
-        self.media_manager = MediaManager(self.home)
-
-        with open(home / 'quiz.yaml') as f:
-            self.quiz_data = yaml.load(f, Loader=yaml.SafeLoader)
-            self.question_title = self.quiz_data.get('question_title', 'Question')
+        self._media_manager = media_manager
+        self.media = []
+        self.fingerprints = {}
+        # Files the quiz was read from, and the questions each included file
+        # contributed as {start index: (path, digest, count)}
+        self.sources = [home / 'quiz.yaml']
+        self.segments = {}
+        self.include_errors = []
+
+        with trace.span('quiz.load'):
+            self.quiz_data = self.load()
+            self.question_title = 'Question'
+            if isinstance(self.quiz_data, dict):
+                self.question_title = self.quiz_data.get('question_title', self.question_title)
+
+    def load_file(self, path):
+        # Parsed files are cached by their hash, only when a media manager,
+        # and with it the cache, is in use
+        content = path.read_bytes()
+        digest = util.bytes_digest(content)
+        cache = self._media_manager.cache if self._media_manager is not None else None
+        if cache is not None:
+            data = cache.parsed_quiz(digest)
+            if data is not None:
+                trace.count('quiz.cache_hit')
+                return digest, data
+        with trace.span('quiz.parse_yaml', file=path.name):
+            data = yaml.load(content, Loader=Loader)
+        if cache is not None and isinstance(data, (dict, list)):
+            cache.add_parsed_quiz(digest, data)
+        return digest, data
+
+    def load(self):
+        digest, data = self.load_file(self.home / 'quiz.yaml')
+        digests = {digest}
+        questions = data.get('quiz') if isinstance(data, dict) else None
+        if isinstance(questions, list) and any(map(is_include, questions)):
+            data['quiz'] = self.load_includes(questions, digests)
+        if self._media_manager is not None:
+            self._media_manager.cache.keep_parsed_quizzes(digests)
+        return data
+
+    def load_includes(self, questions, digests):
+        # Included files are read in parallel and spliced into the question
+        # list, so numbering stays global
+        paths = [self.home / q['include'] for q in questions if is_include(q) and is_file_name(q['include'])]
+        with ThreadPoolExecutor(max_workers=max(1, min(8, len(paths)))) as executor:
+            futures = {path: executor.submit(self.load_file, path) for path in paths}
+
+        res = []
+        for k, question in enumerate(questions):
+            if not is_include(question):
+                res.append(question)
+                continue
+            name = question['include']
+            entry = f'Entry {k + 1} of quiz.yaml'
+            if not is_file_name(name):
+                self.include_errors.append(("'include' must be a file name", question, entry))
+                continue
+            path = self.home / name
+            self.sources.append(path)
+            try:
+                digest, data = futures[path].result()
+                # A file included more than once needs its own questions each time
+                data = copy.deepcopy(data)
+            except OSError:
+                self.include_errors.append((f"included file '{name}' could not be read", question, entry))
+                continue
+            except yaml.YAMLError as ex:
+                self.include_errors.append((f"included file '{name}' is not valid YAML: {ex}", question, entry))
+                continue
+            if isinstance(data, dict):
+                data = [data]
+            if not isinstance(data, list) or not all(isinstance(q, dict) for q in data):
+                self.include_errors.append((f"included file '{name}' must contain a question or a list of questions", question, entry))
+                continue
+            if any(map(is_include, data)):
+                self.include_errors.append((f"included file '{name}' cannot include other files", question, entry))
+                continue
+            digests.add(digest)
+            self.segments[len(res)] = (path, digest, len(data))
+            res.extend(data)
+        return res
+
+    @property
+    def media_manager(self):
+        # Created on first use, checking a quiz does not touch its cache
+        if self._media_manager is None:
+            self._media_manager = MediaManager(self.home)
+        return self._media_manager
+
+    def check(self):
+        # Runs all validation without downloading anything and returns every
+        # failure instead of stopping at the first one
+        with validator.collect() as errors:
+            self.handle_metadata()
+            questions = self.quiz_data.get('quiz') if isinstance(self.quiz_data, dict) else None
+            for i, question in enumerate(questions if isinstance(questions, list) else []):
+                self.handle(question, i)
+        return errors
 
-    def parse(self):
+    def parse(self, previous=None, background=None):
+        # previous maps fingerprints to questions handled by an earlier parse
         log.debug(f'Parsing Quiz metadata')
+        previous = previous or {}
         try:
-            validator.required(self.quiz_data, ['title', 'subtitle'])
-            for i, question in enumerate(self.quiz_data['quiz']):
-                self.handle(question, i)
+            with trace.span('quiz.validate'):
+                self.handle_metadata()
+                questions = self.quiz_data['quiz']
+                i = 0
+                while i < len(questions):
+                    i = self.handle_segment(questions, i, previous)
+            self.media_manager.fetch_all(self.media, background)
+            self.media_manager.evict(self.media_manager.media_items(questions))
             return self.quiz_data
         except validator.ValidationFailed as ex:
             log.error(f'Validation failed for {ex.identity()}')
@@ -44,6 +155,53 @@ class Quiz:
         finally:
             self.media_manager.save_cache()
 
+    def handle_segment(self, questions, i, previous):
+        # Questions from an unchanged included file at the same position are
+        # reused as a whole, otherwise each question is looked at on its own.
+        # Returns the index of the next question to handle.
+        if i not in self.segments:
+            self.handle_question(questions, i, previous)
+            return i + 1
+        path, digest, count = self.segments[i]
+        fingerprint = util.fingerprint([self.question_title, i, digest])
+        reused = previous.get(fingerprint)
+        if reused is not None and all(map(self.is_reusable, reused)):
+            log.debug(f'Reusing questions from {path.name}')
+            questions[i:i + count] = reused
+        else:
+            for j in range(i, i + count):
+                self.handle_question(questions, j, previous)
+        self.fingerprints[fingerprint] = questions[i:i + count]
+        return i + count
+
+    def handle_question(self, questions, i, previous):
+        fingerprint = util.fingerprint([self.question_title, i, questions[i]])
+        if self.is_reusable(previous.get(fingerprint)):
+            questions[i] = previous[fingerprint]
+        else:
+            self.handle(questions[i], i)
+        self.fingerprints[fingerprint] = questions[i]
+
+    def handle_metadata(self):
+        if not isinstance(self.quiz_data, dict):
+            validator.fail('quiz file must contain a mapping', self.quiz_data, 'quiz.yaml')
+            return
+        for message, data, entry in self.include_errors:
+            validator.fail(message, data, entry)
+        validator.required(self.quiz_data, ['title', 'subtitle', 'quiz'])
+        validator.is_list(self.quiz_data, 'quiz')
+        validator.non_negative_int(self.quiz_data, 'media_window')
+        self.quiz_data.setdefault('media_window', MEDIA_WINDOW)
+
+    def is_reusable(self, question):
+        if question is None:
+            return False
+        return all('file' in m and not m.get('pending') for m in self.media_manager.media_items([question]))
+
+    def local_media(self):
+        items = self.media_manager.media_items(self.quiz_data['quiz'])
+        return [self.home / m['url'] for m in items if is_local_media(m)]
+
     def handle_text(self, data):
         log.debug('Type: text')
 
@@ -51,7 +209,7 @@ class Quiz:
         log.debug(f'Type: {data["type"]}')
         validator.required(data, ['url'])
         validator.mutually_exclusive(data, ['end', 'len'])
-        self.media_manager.handle_media(data)
+        self.media.append(data)
 
     handle_audio = handle_media
     handle_video = handle_media
@@ -59,11 +217,14 @@ class Quiz:
     def handle_image(self, data):
         validator.required(data, ['url'])
         log.debug('Type: image')
-        self.media_manager.handle_image(data)
+        self.media.append(data)
 
     def handle_super(self, data):
         log.debug('Type: super')
         validator.non_empty(data, 'questions')
+        validator.is_list(data, 'questions')
+        if not isinstance(data.get('questions'), list):
+            return
 
         for i, question in enumerate(data['questions']):
             self.handle(question, data['number'], i)
@@ -73,99 +234,314 @@ class Quiz:
             sub = ''
         else:
             sub = f'{string.ascii_lowercase[sub]}'
-        data['number'] = number
         title = f'{self.question_title} {number+1}{sub}'
+        if not isinstance(data, dict):
+            validator.fail('question must be a mapping', data, title)
+            return
+        data['number'] = number
         data['title'] = title
         log.debug(f'Parsing: {title}')
         data.setdefault('type', 'text')
 
         validator.one_of(data, 'type', TYPES)
+        if data['type'] not in TYPES:
+            return
 
-        getattr(self, f'handle_{data["type"]}')(data)
+        with trace.span(f'handle.{data["type"]}', title=title):
+            getattr(self, f'handle_{data["type"]}')(data)
 
         answer = data.get('answer', '')
-        if not util.is_media_type(answer):
+        if not isinstance(answer, dict):
             log.debug('Simple text answer')
             return
 
-        log.debug('Media answer, handling media')
         # For debugging purposes
         answer['title'] = f'Answer to {title}'
-        getattr(self, f'handle_{answer["type"]}')(answer)
+        answer.setdefault('type', 'text')
+        validator.one_of(answer, 'type', ANSWER_TYPES)
+        if not util.is_media_type(answer):
+            return
+
+        log.debug('Media answer, handling media')
+        with trace.span(f'handle.{answer["type"]}', title=answer['title']):
+            getattr(self, f'handle_{answer["type"]}')(answer)
 
     def clean_media(self, remove_all):
         self.media_manager.clean(self.quiz_data, remove_all)
 
-def setup_symlinks(args):
-    for p in link_paths:
-        (args.reveal_dir / p).symlink_to(args.dir / p)
+def is_include(question):
+    return isinstance(question, dict) and 'include' in question
 
-def teardown_symlinks(args):
-    for p in link_paths:
-        (args.reveal_dir / p).unlink()
+def is_file_name(value):
+    return isinstance(value, str) and value.strip() != ''
 
-def render(args, both=False):
-    try:
-        quiz = Quiz(args.dir)
-        quiz_data = quiz.parse()
-
-        template = Template(filename=str(args.template_file), output_encoding='utf-8')
-        if not both:
-            development = bool(getattr(args, 'development'))
-            (args.dir / 'index.html').write_bytes(template.render(answers=args.answers, development=development, **quiz_data))
+def media_manager(args):
+    shared_dir = None
+    if args.shared_cache:
+        if args.reveal_dir.is_dir():
+            shared_dir = args.reveal_dir / 'media-cache'
         else:
-            (args.dir / 'index.html').write_bytes(template.render(answers=False, **quiz_data))
-            (args.dir / 'answers.html').write_bytes(template.render(answers=True, **quiz_data))
+            log.warning(f"'{args.reveal_dir}' does not exist, shared media cache disabled")
+    image_profile = None
+    if args.optimize_images:
+        image_profile = (args.image_format, args.image_quality)
+    transcode_profile = None
+    if args.transcode:
+        transcode_profile = (args.video_bitrate, args.audio_bitrate)
+    return MediaManager(
+        args.dir, args.jobs, args.host_jobs, shared_dir, image_profile,
+        args.cache_budget, args.shared_cache_budget,
+        transcode_profile, args.transcode_jobs,
+    )
+
+class Fragments:
+    # Questions rendered one at a time with the template's render_entry def,
+    # keyed by the question, the template and the flags it is rendered with
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.rendered = {}
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def render(self, template, questions, **flags):
+        entry = template.get_def('render_entry')
+        keys = [util.fingerprint([template.source_digest, flags, q]) for q in questions]
+        cached = self.cache.fragments(set(keys)) if self.cache is not None else {}
+        parts = []
+        for key, question in zip(keys, questions):
+            html = cached.get(key)
+            if html is None:
+                html = entry.render(question, **flags)
+                with self.lock:
+                    self.rendered[key] = html
+            else:
+                trace.count('render.fragment_hit')
+            parts.append(html)
+        with self.lock:
+            self.used.update(keys)
+        return b''.join(parts).decode('utf-8')
+
+    def save(self):
+        if self.cache is not None:
+            self.cache.set_fragments(self.rendered, self.used)
+
+def render_page(template, name, fragments=None, **kwargs):
+    with trace.span('render.template', page=name):
+        # Custom templates without render_entry are rendered as a whole
+        if fragments is not None and template.has_def('render_entry'):
+            kwargs['slides'] = fragments.render(
+                template,
+                kwargs['quiz'],
+                answers=kwargs['answers'],
+                development=kwargs['development'],
+            )
+        return template.render(**kwargs)
+
+def write_page(path, content):
+    with trace.span('render.write', page=path.name, bytes=len(content)) as span:
+        span['changed'] = util.write_if_changed(path, content)
+        return span['changed']
+
+def write_quiz(args, template, quiz_data, both=False, cache=None):
+    # Returns whether any page changed
+    fragments = Fragments(cache)
+    if not both:
+        development = bool(getattr(args, 'development'))
+        changed = write_page(args.dir / 'index.html', render_page(template, 'index.html', fragments, answers=args.answers, development=development, **quiz_data))
+    else:
+        pages = {'index.html': False, 'answers.html': True}
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+            rendered = {
+                name: executor.submit(render_page, template, name, fragments, answers=answers, development=False, **quiz_data)
+                for name, answers in pages.items()
+            }
+            changed = False
+            for name, future in rendered.items():
+                changed = write_page(args.dir / name, future.result()) or changed
+    fragments.save()
+    return changed
 
+def render(args, both=False):
+    try:
+        with trace.span('render'):
+            quiz = Quiz(args.dir, media_manager(args))
+            quiz_data = quiz.parse()
+            write_quiz(args, load_template(args.template_file), quiz_data, both, quiz.media_manager.cache)
+        return True
     except validator.ValidationFailed:
         pass
     except:
         log.exception('Something went wrong')
-
-def watch(args):
-    to_watch = args.dir / 'quiz.yaml'
-    log.info(f"Watching '{to_watch}'")
+    return False
+
+class WatchSession:
+    def __init__(self, args, debounce=0.3, on_build=None):
+        self.args = args
+        self.on_build = on_build
+        self.debounce = debounce
+        self.quiz_file = args.dir / 'quiz.yaml'
+        self.template_file = Path(args.template_file).resolve()
+        self.media_manager = media_manager(args)
+        self.background = JobQueue(self.media_manager.download_jobs, self.media_ready)
+        self.template = None
+        self.questions = {}
+        self.watched = {str(self.quiz_file), str(self.template_file)}
+        self.sources = {str(self.quiz_file)}
+        self.changed = set()
+        self.timer = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def build(self, reload=False):
+        # reload forces on_build, e.g., when local media changed but the
+        # pages did not
+        with self.build_lock:
+            try:
+                with trace.span('render'):
+                    if self.template is None:
+                        self.template = load_template(self.template_file)
+                    quiz = Quiz(self.args.dir, self.media_manager)
+                    # Included files are watched even if the quiz is invalid
+                    self.sources = set(str(p.resolve()) for p in quiz.sources)
+                    self.watched.update(self.sources)
+                    quiz_data = quiz.parse(self.questions, self.background)
+                    self.questions = quiz.fingerprints
+                    self.watched = {str(self.template_file)} | self.sources
+                    self.watched.update(str(p.resolve()) for p in quiz.local_media())
+                    changed = write_quiz(self.args, self.template, quiz_data, cache=self.media_manager.cache)
+                if self.on_build is not None and (changed or reload):
+                    self.on_build()
+                return True
+            except validator.ValidationFailed:
+                pass
+            except:
+                log.exception('Something went wrong')
+            return False
+
+    def notify(self, path):
+        if path not in self.watched:
+            return
+        self.schedule(path)
+
+    def media_ready(self, key):
+        self.schedule()
+
+    def schedule(self, path=None):
+        # Coalesce bursts of events into a single rebuild
+        with self.lock:
+            if path is not None:
+                self.changed.add(path)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.rebuild)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def rebuild(self):
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            self.timer = None
+        if str(self.template_file) in changed:
+            log.info('Template changed, reloading')
+            self.template = None
+        if changed:
+            log.info('Change detected, building...')
+        else:
+            log.info('Media downloaded, building...')
+        if self.build(bool(changed - self.sources - {str(self.template_file)})):
+            log.info('Done')
+
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.background.shutdown()
+
+def watch(args, on_build=None):
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    session = WatchSession(args, args.debounce, on_build)
+    log.info(f"Watching '{session.quiz_file}'")
     log.info(f"Press Ctrl+C to stop")
-    to_watch_name = str(to_watch)
-    render(args)
+    session.build()
 
     class Handler(FileSystemEventHandler):
-        def on_modified(self, event):
-            if event.event_type == 'modified':
-                if event.src_path == to_watch_name:
-                    log.info('Change detected, building...')
-                    render(args)
-                    log.info('Done')
+        def on_any_event(self, event):
+            if event.event_type not in ('created', 'modified', 'moved'):
+                return
+            session.notify(event.src_path)
+            if event.event_type == 'moved':
+                session.notify(event.dest_path)
 
     observer = Observer()
-    observer.schedule(Handler(), str(to_watch.parent))
+    observer.schedule(Handler(), str(args.dir), recursive=True)
+    home = args.dir.resolve()
+    observed = {home}
+    if args.dir not in session.template_file.parents:
+        observer.schedule(Handler(), str(session.template_file.parent))
+        observed.add(session.template_file.parent)
+
+    def observe_sources():
+        # Included files can live outside the quiz directory
+        for source in session.sources:
+            directory = Path(source).parent
+            if directory in observed or home in directory.parents:
+                continue
+            observer.schedule(Handler(), str(directory))
+            observed.add(directory)
+
+    observe_sources()
     observer.start()
 
     try:
         while True:
             time.sleep(1)
+            observe_sources()
     except KeyboardInterrupt:
         observer.stop()
+    session.stop()
     observer.join()
     log.info('Watch stopped')
 
 def generate(args, watch_file):
+    from .server import DevServer
+
     util.check_data_dir(args.dir)
-    with util.NpmRunner(args.reveal_dir) as npm:
+    with DevServer(args.dir, args.reveal_dir, args.port) as server:
         try:
-            setup_symlinks(args)
             if not watch_file:
                 render(args)
+                server.serve_forever()
             else:
-                watch(args)
-            npm.process.wait()
+                watch(args, server.reload)
         except KeyboardInterrupt:
             log.info('Quitting')
-        finally:
-            teardown_symlinks(args)
+
+def check(args):
+    failed = 0
+    for home in args.dirs:
+        try:
+            errors = Quiz(home).check()
+        except (OSError, yaml.YAMLError) as ex:
+            log.error(f'{home}: could not read quiz: {ex}')
+            failed += 1
+            continue
+        except:
+            log.exception(f'{home}: something went wrong checking the quiz')
+            failed += 1
+            continue
+        for ex in errors:
+            log.error(f'{home}: {ex.identity()}: {ex.message}')
+        if errors:
+            failed += 1
+    if failed:
+        log.error(f'{failed} of {len(args.dirs)} quizzes have problems')
+        sys.exit(1)
+    log.info(f'{len(args.dirs)} quizzes checked, no problems found')
 
 def cleanup(args):
-    q = Quiz(args.dir)
+    q = Quiz(args.dir, media_manager(args))
     q.clean_media(args.aggressive)
 
 def make(args):
@@ -176,19 +552,87 @@ def watch_make(args):
 
 def finalize(args):
     util.check_data_dir(args.dir)
-    copy_paths = ['dist']
-    log.info('Copying required files')
-    for p in copy_paths:
-        dest = args.dir / p
-        if dest.exists():
-            log.info(f'  Skipping {p}')
-        else:
-            src = args.reveal_dir / p
-            log.info(f'  Copying {src} -> {dest}')
-            shutil.copytree(src, dest)
+    if not render(args, True):
+        return False
 
-    render(args, True)
+    pages = [args.dir / 'index.html', args.dir / 'answers.html']
+    log.info('Copying required files')
+    with trace.span('finalize.copy'):
+        assets = bundle.copy_assets(pages, args.reveal_dir, args.dir)
+    log.info('Compressing text files')
+    with trace.span('finalize.compress'):
+        bundle.precompress(pages + assets)
     log.info('Quiz successfully finalized')
+    return True
+
+def find_quizzes(root):
+    quizzes = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Media directories can be large and never contain quizzes
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and d not in ('data', 'sources'))
+        if 'quiz.yaml' in filenames:
+            quizzes.append(Path(dirpath))
+    return quizzes
+
+def _init_worker(level):
+    logger = logging.getLogger('synquiz')
+    if not logger.handlers:
+        from .output import setup_logger
+        setup_logger(level)
+
+def _build_one(options, home, final):
+    args = argparse.Namespace(**options, dir=home)
+    try:
+        if final:
+            return finalize(args)
+        util.check_data_dir(home)
+        return render(args)
+    except:
+        log.exception(f'Something went wrong building {home}')
+        return False
+
+def build_all(args, final):
+    quizzes = find_quizzes(args.root)
+    if not quizzes:
+        log.warning(f'No quizzes found in {args.root}')
+        return
+    log.info(f'Building {len(quizzes)} quizzes with {args.workers} workers')
+
+    # Workers find the compiled template in the on-disk template cache and
+    # downloads are deduplicated through the shared media cache
+    load_template(args.template_file)
+    options = {k: v for k, v in vars(args).items() if k not in ('func', 'root')}
+    options['shared_cache'] = True
+
+    failed = []
+    level = logging.getLogger('synquiz').level
+    with trace.span('build_all', quizzes=len(quizzes)), ProcessPoolExecutor(
+        max_workers=max(1, min(args.workers, len(quizzes))),
+        initializer=_init_worker,
+        initargs=(level,),
+    ) as executor:
+        futures = {executor.submit(_build_one, options, home, final): home for home in quizzes}
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as ex:
+                log.error(f'Worker building {futures[future]} failed: {ex}')
+                ok = False
+            if not ok:
+                failed.append(futures[future])
+
+    log.info(f'{len(quizzes) - len(failed)} of {len(quizzes)} quizzes built')
+    if failed:
+        log.error('Failed to build:')
+        for home in sorted(failed):
+            log.error(f'  {home}')
+        sys.exit(1)
+
+def make_all(args):
+    build_all(args, False)
+
+def finalize_all(args):
+    build_all(args, True)
 
 def init(args):
     if args.dir.exists():
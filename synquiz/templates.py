@@ -0,0 +1,49 @@
+import os
+import logging
+import threading
+
+from pathlib import Path
+
+import synquiz.util as util
+
+log = logging.getLogger('synquiz')
+
+_templates = {}
+_lock = threading.Lock()
+
+def cache_dir():
+    return util.user_cache_dir() / 'templates'
+
+def module_directory(digest):
+    import mako
+
+    path = cache_dir() / f'mako-{mako.__version__}' / digest
+    try:
+        path.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        log.debug(f'Could not create template cache in {path}')
+        return None
+    return str(path)
+
+def load_template(path):
+    import mako
+    from mako.template import Template
+
+    # Compiled templates are kept in memory and on disk, keyed by the path,
+    # the contents of the template and the Mako version
+    path = Path(path).resolve()
+    digest = util.file_digest(path)
+    key = (str(path), digest, mako.__version__)
+    with _lock:
+        template = _templates.get(key)
+        if template is None:
+            log.debug(f'Loading template {path}')
+            template = Template(
+                filename=str(path),
+                output_encoding='utf-8',
+                module_directory=module_directory(digest),
+            )
+            # Part of the key of rendered fragments
+            template.source_digest = digest
+            _templates[key] = template
+        return template
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+log = logging.getLogger('synquiz')
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def span(self, name, **args):
+        # The yielded dict can be filled in while the span is open, e.g.,
+        # with the number of bytes downloaded
+        if not self.enabled:
+            yield args
+            return
+        start = self._now()
+        try:
+            yield args
+        finally:
+            event = {
+                'name': name,
+                'cat': name.split('.')[0],
+                'ph': 'X',
+                'ts': start,
+                'dur': self._now() - start,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in args.items()},
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.events.append({
+                'name': name,
+                'ph': 'C',
+                'ts': self._now(),
+                'pid': os.getpid(),
+                'args': {name: self.counters[name]},
+            })
+
+    def write(self, path):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+        log.info(f'Trace written to {path}')
+
+    def summary(self):
+        spans = {}
+        with self.lock:
+            for e in self.events:
+                if e['ph'] != 'X':
+                    continue
+                s = spans.setdefault(e['name'], {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0})
+                s['count'] += 1
+                s['total'] += e['dur'] / 1000
+                s['max'] = max(s['max'], e['dur'] / 1000)
+                s['bytes'] += e['args'].get('bytes', 0)
+            counters = dict(self.counters)
+        return spans, counters
+
+    def print_summary(self):
+        spans, counters = self.summary()
+        log.info(f"{'phase':32} {'count':>6} {'total ms':>10} {'mean ms':>9} {'max ms':>9} {'bytes':>12}")
+        for name, s in sorted(spans.items(), key=lambda x: -x[1]['total']):
+            log.info(
+                f"{name:32} {s['count']:6} {s['total']:10.1f} {s['total'] / s['count']:9.1f} "
+                f"{s['max']:9.1f} {s['bytes'] or '':>12}"
+            )
+        for name, value in sorted(counters.items()):
+            log.info(f'{name:32} {value:6}')
+
+tracer = Tracer()
+span = tracer.span
+count = tracer.count
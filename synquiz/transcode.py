@@ -0,0 +1,70 @@
+import logging
+import subprocess
+
+from pathlib import Path
+
+import synquiz.jobs as jobs
+
+log = logging.getLogger('synquiz')
+
+# Output formats every browser plays: H.264/AAC in MP4 with the index at
+# the start, so playback starts before the whole file is loaded, and Opus
+SUFFIXES = {
+    'video': '.mp4',
+    'audio': '.opus',
+    'gif': '.mp4',
+}
+
+def kind(data, file):
+    if Path(file).suffix.lower() == '.gif':
+        return 'gif'
+    if data['type'] in ('audio', 'video'):
+        return data['type']
+    return None
+
+def variant_key(digest, kind, video_bitrate, audio_bitrate):
+    return ('transcode', digest, kind, video_bitrate, audio_bitrate)
+
+def command(src, dest, kind, video_bitrate, audio_bitrate):
+    options = {
+        'video': [
+            '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', video_bitrate, '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', audio_bitrate,
+            '-movflags', '+faststart',
+        ],
+        'audio': ['-vn', '-c:a', 'libopus', '-b:a', audio_bitrate],
+        # H.264 needs even dimensions, GIFs have no audio
+        'gif': [
+            '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', video_bitrate, '-pix_fmt', 'yuv420p',
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-an',
+            '-movflags', '+faststart',
+        ],
+    }[kind]
+    return ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', str(src), *options, str(dest)]
+
+# Height of thumbnails in the development overview
+THUMBNAIL_HEIGHT = 120
+
+def poster_key(digest):
+    return ('poster', digest)
+
+def thumbnail_key(digest):
+    return ('thumbnail', digest, THUMBNAIL_HEIGHT)
+
+def frame_command(src, dest, height=None):
+    # Clips are cut at their start offset, so their first frame is the
+    # frame the question starts at
+    scale = ['-vf', f'scale=-2:{height}'] if height else []
+    return ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', str(src), '-frames:v', '1', *scale, '-q:v', '3', str(dest)]
+
+def _run(command, dest):
+    result = jobs.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8')
+    if result.returncode != 0 or not Path(dest).is_file():
+        raise RuntimeError(result.stdout)
+    return dest
+
+def frame(src, dest, height=None):
+    return _run(frame_command(src, dest, height), dest)
+
+def transcode(src, dest, kind, video_bitrate, audio_bitrate):
+    return _run(command(src, dest, kind, video_bitrate, audio_bitrate), dest)
@@ -1,9 +1,14 @@
+import json
+import argparse
 import random
+import hashlib
 import string
-import subprocess
 import os
+import fcntl
+import shutil
 import logging
 
+from contextlib import contextmanager
 from pathlib import Path
 
 log = logging.getLogger('synquiz')
@@ -14,9 +19,64 @@ TEMPLATE_FILE = DATA_DIR / 'template.html'
 def randstr():
     return ''.join([random.choice(string.ascii_lowercase) for _ in range(5)])
 
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def fingerprint(obj):
+    return bytes_digest(json.dumps(obj, sort_keys=True, default=str).encode('utf-8'))
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def check_dependencies(dependencies):
+    for d in dependencies:
+        if not shutil.which(d):
+            log.error(f"Missing dependency '{d}', Synquiz will not work as expected")
+
+def write_if_changed(path, content):
+    # Unchanged files are left alone, keeping their modification time and
+    # not triggering file system events
+    try:
+        if path.stat().st_size == len(content) and path.read_bytes() == content:
+            return False
+    except FileNotFoundError:
+        pass
+    tmp = path.with_name(f'.{path.name}.{randstr()}')
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+    return True
+
+def user_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'synquiz'
+
 def check_data_dir(home):
     (home / 'data').mkdir(exist_ok=True)
 
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(value):
+    # Byte counts such as 500M or 2G, used for argparse types
+    number = value.strip().upper().rstrip('B')
+    unit = number[-1:] if number[-1:] in SIZE_UNITS else ''
+    try:
+        return int(float(number[:len(number) - len(unit)]) * SIZE_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}'")
+
+def format_size(size):
+    for unit in ['B', 'K', 'M', 'G']:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'T'
+    return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+
 def is_media_type(data):
     return isinstance(data, dict) and data.get('type') in ('audio', 'video', 'image')
 
@@ -27,17 +87,55 @@ def to_hms(total):
     st = f'{hours:02}:{mins:02}:{secs:06.03f}'
     return st
 
-class NpmRunner:
-    def __init__(self, reveal_dir):
-        self.reveal_dir = reveal_dir
+FICLONE = 0x40049409
+
+def _reflink(src, dest):
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def link_or_copy(src, dest):
+    if dest.exists():
+        return
+    tmp = dest.with_name(f'.{randstr()}{dest.suffix}')
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            _reflink(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
 
-    def __enter__(self):
-        os.chdir(self.reveal_dir)
-        self.process = subprocess.Popen(['npm', 'start'])
-        return self
+@contextmanager
+def file_lock(path):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
-    def __exit__(self, type, value, traceback):
-        if self.process and self.process.poll() is not None:
-            log.info('Terminating npm')
-            self.process.terminate()
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
 
+@contextmanager
+def temporary_file_lock(path):
+    # Like file_lock, but the lock file is removed on release. A waiter
+    # that locked a file removed in the meantime locks the new one instead.
+    while True:
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield
+    finally:
+        remove_file(path)
+        f.close()
@@ -1,30 +1,65 @@
+import threading
+
+from contextlib import contextmanager
+
 class ValidationFailed(Exception):
-    def __init__(self, message, data):
+    def __init__(self, message, data, title=None):
         self.message = message
         self.data = data
+        self.title = title
 
     def identity(self):
-        if 'type' in self.data:
+        if self.title is not None:
+            return self.title
+        if isinstance(self.data, dict) and 'type' in self.data:
             return self.data.get('title', 'Unknown')
         return 'Quiz metadata'
 
+_state = threading.local()
+
+@contextmanager
+def collect():
+    # Within this block failures are gathered instead of raised, so a whole
+    # quiz can be checked in one pass
+    errors = []
+    _state.errors = errors
+    try:
+        yield errors
+    finally:
+        _state.errors = None
+
+def fail(message, data, title=None):
+    # title identifies data that cannot identify itself
+    ex = ValidationFailed(message, data, title)
+    errors = getattr(_state, 'errors', None)
+    if errors is None:
+        raise ex
+    errors.append(ex)
 
 def required(data, items):
     if isinstance(items, str):
         items = [items]
     for it in items:
         if it not in data:
-            raise ValidationFailed(f"'{it}' is required", data)
+            fail(f"'{it}' is required", data)
 
 def mutually_exclusive(data, items):
     if all(x in data for x in items):
-        raise ValidationFailed(f"{' and '.join(map(repr,items))} cannot be specified at the same time", data)
+        fail(f"{' and '.join(map(repr,items))} cannot be specified at the same time", data)
 
 def non_empty(data, item):
     if not data.get(item):
-        raise ValidationFailed(f"'{item}' cannot be empty", data)
+        fail(f"'{item}' cannot be empty", data)
 
 def one_of(data, item, legal):
     if item in data and not data[item] in legal:
-        raise ValidationFailed(f"'{item}' must be one of {str(legal)}", data)
+        fail(f"'{item}' must be one of {str(legal)}", data)
+
+def is_list(data, item):
+    if item in data and not isinstance(data[item], list):
+        fail(f"'{item}' must be a list", data)
 
+def non_negative_int(data, item):
+    value = data.get(item, 0)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        fail(f"'{item}' must be a non-negative integer", data)